@@ -2,24 +2,39 @@ import requests
 import time
 import json
 import os
-from dotenv import load_dotenv
 
-import psycopg2
 from psycopg2.extras import execute_values
-
-load_dotenv()
+from db import connect
+import metrics
 
 API_KEY = os.getenv('ALPACA_API_KEY')
 API_SECRET = os.getenv('ALPACA_API_SECRET')
-TS_HOST = os.getenv('TS_HOST')
-TS_PORT = os.getenv('TS_PORT', 5432)
-TS_NAME = os.getenv('TS_DATABASE')
-TS_USER = os.getenv('TS_USER')
-TS_PASSWORD = os.getenv('TS_PASSWORD')
 
 
 HEADERS = {"APCA-API-KEY-ID": API_KEY, "APCA-API-SECRET-KEY": API_SECRET}
 
+# SQL insert statement for bar rows built by bar_to_row; bars already stored
+# for the ticker and time are skipped
+INSERT_BARS_SQL = """
+INSERT INTO stocks (trade_time, close_price, high_price, low_price, num_trades, open_price, volume, vwap, ticker)
+VALUES %s
+ON CONFLICT (ticker, trade_time) DO NOTHING;
+"""
+
+# Convert an Alpaca bar (REST or stream) to a row for INSERT_BARS_SQL
+def bar_to_row(bar, ticker):
+    return (
+        bar["t"],  # trade_time
+        bar["c"],  # close_price
+        bar["h"],  # high_price
+        bar["l"],  # low_price
+        bar["n"],  # num_trades
+        bar["o"],  # open_price
+        bar["v"],  # volume
+        bar["vw"],  # vwap
+        ticker      # ticker
+    )
+
 
 
 def get_stock_data(ticker, start, end):
@@ -44,9 +59,11 @@ def get_stock_data(ticker, start, end):
         if page_token:
             params["page_token"] = page_token
 
-        r = requests.get(base_url, headers=HEADERS, params=params)
-        data = r.json()
+        with metrics.timer("alpaca_page_seconds"):
+            r = requests.get(base_url, headers=HEADERS, params=params)
+            data = r.json()
         bars = data.get("bars", [])
+        metrics.inc("alpaca_bars_total", len(bars))
         all_bars.extend(bars)
 
         page_token = data.get("next_page_token", None)
@@ -64,13 +81,7 @@ def get_stock_data(ticker, start, end):
 
 def upload_to_db(filename, ticker):
     # Connect to the TimescaleDB
-    conn = psycopg2.connect(
-        host=TS_HOST,
-        port=TS_PORT,
-        dbname=TS_NAME,
-        user=TS_USER,
-        password=TS_PASSWORD
-    )
+    conn = connect()
     cursor = conn.cursor()
 
     # Load the JSON file
@@ -78,30 +89,10 @@ def upload_to_db(filename, ticker):
         bars = json.load(f)
 
     # Prepare the data for insertion
-    rows = [
-        (
-            bar["t"],  # trade_time
-            bar["c"],  # close_price
-            bar["h"],  # high_price
-            bar["l"],  # low_price
-            bar["n"],  # num_trades
-            bar["o"],  # open_price
-            bar["v"],  # volume
-            bar["vw"],  # vwap
-            ticker      # ticker
-        )
-        for bar in bars
-    ]
-
-    # SQL insert statement
-    sql = """
-    INSERT INTO stocks (trade_time, close_price, high_price, low_price, num_trades, open_price, volume, vwap, ticker)
-    VALUES %s
-    ON CONFLICT (trade_time, id) DO NOTHING;
-    """
+    rows = [bar_to_row(bar, ticker) for bar in bars]
 
     # Use execute_values for batch insert
-    execute_values(cursor, sql, rows)
+    execute_values(cursor, INSERT_BARS_SQL, rows)
 
     # Commit the transaction and close the connection
     conn.commit()
@@ -109,6 +100,7 @@ def upload_to_db(filename, ticker):
     conn.close()
 
     print(f"Uploaded {len(rows)} rows to the database.")
+    return len(rows)
 
 # Modify the main function to call the upload_to_db function
 def main():
@@ -1,32 +1,45 @@
-import json
-import pandas as pd
-from sklearn.ensemble import IsolationForest
-import plotly.graph_objects as go
-import numpy as np
-import os
-from dotenv import load_dotenv
-
-import psycopg2
-from psycopg2.extras import execute_values
-
-load_dotenv()
-
-TS_HOST = os.getenv('TS_HOST')
-TS_PORT = os.getenv('TS_PORT', 5432)
-TS_NAME = os.getenv('TS_DATABASE')
-TS_USER = os.getenv('TS_USER')
-TS_PASSWORD = os.getenv('TS_PASSWORD')
+from bisect import bisect_left
+from datetime import timedelta
 
-conn = psycopg2.connect(
-        host=TS_HOST,
-        port=TS_PORT,
-        dbname=TS_NAME,
-        user=TS_USER,
-        password=TS_PASSWORD
-    )
-cursor = conn.cursor()
-
-def detect_anomalies(ticker):
+from psycopg2.extras import execute_values
+from db import get_conn
+import metrics
+
+# pandas, sklearn and plotly are imported inside the functions that use them,
+# and the database connection is opened on first query, so importing this
+# module stays cheap.
+
+# Columns the IsolationForest is fitted on
+FEATURES = ['o', 'h', 'l', 'c', 'v', 'vw', 'price_change', 'percentage_change']
+
+ISOLATION_FOREST_PARAMS = {
+    "n_estimators": 100,
+    "contamination": 0.07,  # 7% anomalies
+    "random_state": 42,
+}
+
+# Anomalies closer together than this are combined into one point
+CLUSTER_HOURS = 24
+
+# SQL insert statement for (trade_time, ticker) anomaly rows
+INSERT_ANOMALIES_SQL = """
+INSERT INTO anomaly (trade_time, ticker)
+VALUES %s
+ON CONFLICT (trade_time, ticker) DO NOTHING;
+"""
+
+# Stored anomaly times of a ticker within a time range
+ANOMALY_TIMES_SQL = """
+SELECT trade_time FROM anomaly
+WHERE ticker = %s AND trade_time BETWEEN %s AND %s
+ORDER BY trade_time;
+"""
+
+def detect_anomalies(ticker, show=True):
+    import pandas as pd
+    from sklearn.ensemble import IsolationForest
+
+    cursor = get_conn().cursor()
     cursor.execute("SELECT * FROM stocks WHERE ticker = %s", (ticker,))
 
     results = cursor.fetchall()
@@ -43,15 +56,12 @@ def detect_anomalies(ticker):
 
     df['price_change'] = df['c'].diff()
     df['percentage_change'] = df['c'].pct_change()
-    X = df[['o', 'h', 'l', 'c', 'v', 'vw', 'price_change', 'percentage_change']].dropna()
+    X = df[FEATURES].dropna()
 
-    iso_forest = IsolationForest(
-        n_estimators=100,
-        contamination=0.07,  # 7% anomalies
-        random_state=42
-    )
+    iso_forest = IsolationForest(**ISOLATION_FOREST_PARAMS)
 
-    iso_forest.fit(X)
+    with metrics.timer("isolation_forest_fit_seconds"):
+        iso_forest.fit(X)
     labels = iso_forest.predict(X)
     df = df.iloc[len(df) - len(X):]  # Adjust for dropped rows due to diff and pct_change
     df['anomaly_label'] = labels
@@ -64,7 +74,7 @@ def detect_anomalies(ticker):
     df['mid_point'] = (df['h'] + df['l']) / 2
 
     # Combine points within 24 hours
-    time_threshold = pd.Timedelta(hours=24)
+    time_threshold = pd.Timedelta(hours=CLUSTER_HOURS)
 
     anomalies = df[df["anomaly_label"] == -1].copy()
     clusters = []
@@ -90,11 +100,14 @@ def detect_anomalies(ticker):
         mp = cluster_df["mid_point"].mean()
         points.append((time, mp))
 
-    display_data(df, points, ticker)
+    if show:
+        display_data(df, points, ticker)
 
     return points
 
 def display_data(df, points, ticker):
+    import plotly.graph_objects as go
+
     fig = go.Figure(
         data=[
             go.Candlestick(
@@ -126,6 +139,28 @@ def display_data(df, points, ticker):
 
     fig.show()
 
+# Drop the points within CLUSTER_HOURS of an anomaly already stored for the
+# ticker. stream.py stores a cluster at its first anomalous hour and
+# detect_anomalies at its median hour, which also moves as the cluster grows,
+# so the same cluster would otherwise be stored more than once.
+def new_clusters(points, ticker):
+    if not points:
+        return points
+    window = timedelta(hours=CLUSTER_HOURS)
+    times = [pt[0] for pt in points]
+
+    cursor = get_conn().cursor()
+    cursor.execute(ANOMALY_TIMES_SQL, (ticker, min(times) - window, max(times) + window))
+    stored = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+
+    kept = []
+    for pt in points:
+        i = bisect_left(stored, pt[0] - window)
+        if i == len(stored) or stored[i] > pt[0] + window:
+            kept.append(pt)
+    return kept
+
 def upload_to_db(points, ticker):
     # Prepare the data for insertion
     rows = [
@@ -136,28 +171,23 @@ def upload_to_db(points, ticker):
         for pt in points
     ]
 
-    # SQL insert statement
-    sql = """
-    INSERT INTO anomaly (trade_time, ticker)
-    VALUES %s
-    ON CONFLICT (trade_time, ticker) DO NOTHING;
-    """
-
     # Use execute_values for batch insert
-    execute_values(cursor, sql, rows)
+    conn = get_conn()
+    cursor = conn.cursor()
+    execute_values(cursor, INSERT_ANOMALIES_SQL, rows)
 
-    # Commit the transaction and close the connection
+    # Commit the transaction; the shared connection stays open for later stages
     conn.commit()
     cursor.close()
-    conn.close()
 
     print(f"Uploaded {len(rows)} rows to the database.")
+    return len(rows)
 
 def main():
     ticker = "TSLA"
 
     anomalies = detect_anomalies(ticker)
-    upload_to_db(anomalies, ticker)
+    upload_to_db(new_clusters(anomalies, ticker), ticker)
 
 if __name__ == '__main__':
     main()
@@ -1,74 +1,118 @@
-from flask import Flask, request, jsonify
+import os
+import time
+from contextlib import ExitStack
+
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
-from db import get_db, close_db
-import pandas as pd 
+from db import apply_schema, get_db, close_db
+import metrics
+from queries import BOT_OVERVIEW_QUERY, STOCK_QUERY, bot_overview, rows_to_dicts, search_stock_info, similar_args, time_range_interval
+from responses import respond
+from similarity import QUERY_WINDOW_QUERY, WINDOW, get_index
 
 app = Flask(__name__)
 
 CORS(app)
 
+app.teardown_appcontext(close_db)
+
 def init_db():
-    db = get_db()
-    with open("schema.sql") as f:
-        db.cursor().execute(f.read())
-    db.commit()
-    
+    apply_schema(get_db())
+
 
 with app.app_context():
     init_db()
 
 
+# ?profile=1 captures a cProfile dump of that request when PROFILE_REQUESTS=1
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS") == "1"
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if PROFILE_REQUESTS and request.args.get("profile"):
+        g.profile_stack = ExitStack()
+        g.profile_stack.enter_context(metrics.profile(f"request-{request.endpoint}"))
+
+@app.after_request
+def record_request_time(response):
+    metrics.observe_request(request, response.status_code, g.request_started)
+    return response
+
+@app.teardown_request
+def stop_request_profile(e=None):
+    stack = g.pop("profile_stack", None)
+    if stack is not None:
+        stack.close()
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/api/v1/stocks", methods=["GET"])
 def get_stocks():
-    stocks = pd.read_csv("static/stock_info.csv", header=0)
-    
     query = request.args.get("query")
-    
-    if query:
-        stocks = stocks[stocks["Ticker"].str.contains(query, case=False)]
-    
-    return jsonify(stocks.to_dict(orient="records")[:100])
+
+    return respond(search_stock_info(query), request)
 
 @app.route("/api/v1/stocks/<ticker>", methods=["GET"])
 def get_stock(ticker):
     db = get_db()
-    
-    stock = db.cursor().execute("SELECT * FROM stocks WHERE ticker = ?", (ticker,)).fetchall()
-    
-    return jsonify(stock.to_dict(orient="records")[0])
+
+    cur = db.cursor()
+    cur.execute(STOCK_QUERY, (ticker,))
+    stock = rows_to_dicts(cur.description, cur.fetchall())
+
+    if not stock:
+        return jsonify({"error": "Unknown ticker", "provided": ticker}), 404
+
+    return respond(stock[0], request)
+
 @app.route("/api/v1/bot-overview", methods=["GET"])
 def get_bot_overview():
     bot = request.args.get("bot")
     time_range = request.args.get("time_range")
-    
-    
+
+
     if bot is None:
         return jsonify({"error": "No bot specified"}), 400
 
-    match time_range:
-        case "1m":
-            filter = "trade_time >= date('now', '-1 month')"
-        case "6m":
-            filter = "trade_time >= date('now', '-6 month')"
-        case "1y":
-            filter = "trade_time >= date('now', '-1 year')"
-        case None | "":
-            filter = "trade_time >= date('now', '-1 year')"
-        case _:
-            return jsonify({"error": "Invalid time range", "provided": time_range}), 400
-        
+    interval = time_range_interval(time_range)
+    if interval is None:
+        return jsonify({"error": "Invalid time range", "provided": time_range}), 400
+
     db = get_db()
-    
-    query = f"""
-    SELECT * FROM stocks
-    """
-    
+
     cur = db.cursor()
-    cur.execute(query, (bot,))
-    
-    
+    cur.execute(BOT_OVERVIEW_QUERY, (bot, interval))
+
+
     result = cur.fetchall()
-    return jsonify(result)
+    payload, columns = bot_overview(cur.description, result, bot, time_range, request.args.get("format"))
+    return respond(payload, request, columns)
+
+@app.route("/api/v1/similar", methods=["GET"])
+def get_similar():
+    params, error = similar_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    ticker, end, k, exclude, same_period = params
+
+    db = get_db()
+
+    index = get_index()
+    if index.needs_refresh():
+        index.refresh(db)
+
+    cur = db.cursor()
+    cur.execute(QUERY_WINDOW_QUERY, (ticker, end))
+    rows = cur.fetchall()
+
+    if len(rows) < WINDOW:
+        return jsonify({"error": f"Need {WINDOW} bars of {ticker} to search", "provided": len(rows)}), 404
+
+    return respond(index.search(rows, k, exclude, same_period), request)
 
 if __name__ == "__main__":
     app.run(port=8080, debug=True)
\ No newline at end of file
@@ -0,0 +1,132 @@
+# Async serving mode for the /api/v1/* routes.
+#
+# Same routes and JSON responses as app.py, served by Quart on an ASGI server
+# with an async psycopg connection pool, so a slow TimescaleDB query only
+# suspends its own request instead of blocking a worker. Launch it with
+# serve.py (see there for worker and concurrency settings), which applies
+# schema.sql once before starting the workers; the workers never run DDL.
+import asyncio
+import os
+import time
+
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+from quart import Quart, Response, g, jsonify, request
+from quart_cors import cors
+
+from db import app_config
+import metrics
+from queries import BOT_OVERVIEW_QUERY, STOCK_QUERY, bot_overview, rows_to_dicts, search_stock_info, similar_args, time_range_interval
+from responses import respond
+from similarity import BARS_SINCE_QUERY, QUERY_WINDOW_QUERY, WINDOW, get_index
+
+app = cors(Quart(__name__))
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+
+
+# Same connection settings as get_db
+def db_conninfo():
+    params = app_config()
+    if "dsn" in params:
+        return params["dsn"]
+    if "database" in params:
+        params["dbname"] = params.pop("database")
+    return make_conninfo(**{k: v for k, v in params.items() if v is not None})
+
+
+pool = AsyncConnectionPool(db_conninfo(), min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, open=False)
+
+
+@app.before_serving
+async def open_pool():
+    await pool.open()
+
+
+@app.after_serving
+async def close_pool():
+    await pool.close()
+
+
+async def fetch(query, params):
+    statement = query.split(None, 1)[0].upper()
+    metrics.inc("db_queries_total", statement=statement)
+    with metrics.timer("db_query_seconds", statement=statement):
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                return cur.description, await cur.fetchall()
+
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+async def record_request_time(response):
+    metrics.observe_request(request, response.status_code, g.request_started)
+    return response
+
+
+# Metrics are per worker process; scrape each worker or run a single worker
+@app.route("/metrics", methods=["GET"])
+async def get_metrics():
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/v1/stocks", methods=["GET"])
+async def get_stocks():
+    query = request.args.get("query")
+
+    return respond(search_stock_info(query), request)
+
+
+@app.route("/api/v1/stocks/<ticker>", methods=["GET"])
+async def get_stock(ticker):
+    description, rows = await fetch(STOCK_QUERY, (ticker,))
+    stock = rows_to_dicts(description, rows)
+
+    if not stock:
+        return jsonify({"error": "Unknown ticker", "provided": ticker}), 404
+
+    return respond(stock[0], request)
+
+
+@app.route("/api/v1/bot-overview", methods=["GET"])
+async def get_bot_overview():
+    bot = request.args.get("bot")
+    time_range = request.args.get("time_range")
+
+    if bot is None:
+        return jsonify({"error": "No bot specified"}), 400
+
+    interval = time_range_interval(time_range)
+    if interval is None:
+        return jsonify({"error": "Invalid time range", "provided": time_range}), 400
+
+    description, result = await fetch(BOT_OVERVIEW_QUERY, (bot, interval))
+    payload, columns = bot_overview(description, result, bot, time_range, request.args.get("format"))
+    return respond(payload, request, columns)
+
+
+@app.route("/api/v1/similar", methods=["GET"])
+async def get_similar():
+    params, error = similar_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    ticker, end, k, exclude, same_period = params
+
+    # Indexing and DTW re-ranking are CPU-bound, so they run off the event loop
+    index = get_index()
+    if index.needs_refresh():
+        _, new_rows = await fetch(BARS_SINCE_QUERY, index.refresh_params())
+        await asyncio.to_thread(index.add_query_rows, new_rows)
+
+    _, rows = await fetch(QUERY_WINDOW_QUERY, (ticker, end))
+
+    if len(rows) < WINDOW:
+        return jsonify({"error": f"Need {WINDOW} bars of {ticker} to search", "provided": len(rows)}), 404
+
+    return respond(await asyncio.to_thread(index.search, rows, k, exclude, same_period), request)
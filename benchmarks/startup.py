@@ -0,0 +1,90 @@
+# Import-time benchmark for the pipeline scripts.
+#
+# Each module is imported in a fresh interpreter under `python -X importtime`
+# and the run fails if the import pulls in one of the heavy dependencies that
+# should only be loaded on first use, or if it takes longer than the budget.
+#
+#   python benchmarks/startup.py
+#   python benchmarks/startup.py --budget-ms 150 --repeat 5 --json
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ["dtw", "anomaly_detection", "classification"]
+
+# Top-level packages that must not be imported just by importing a script
+HEAVY = [
+    "numpy", "pandas", "sklearn", "scipy", "fastdtw", "matplotlib", "plotly",
+    "openai", "requests", "flask",
+]
+
+DEFAULT_BUDGET_MS = 200
+
+
+# Import `module` once under -X importtime and return {package: cumulative_us}
+def measure(module):
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr}")
+
+    timings = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue  # header line
+        name = parts[2].strip()
+        timings[name] = int(parts[1])
+    return timings
+
+
+def check(module, repeat, budget_ms):
+    runs = [measure(module) for _ in range(repeat)]
+    cumulative_ms = min(run.get(module, 0) for run in runs) / 1000
+    loaded = sorted(
+        pkg for pkg in HEAVY if any(pkg in run for run in runs)
+    )
+    return {
+        "module": module,
+        "cumulative_ms": round(cumulative_ms, 2),
+        "budget_ms": budget_ms,
+        "heavy_imports": loaded,
+        "ok": not loaded and cumulative_ms <= budget_ms,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Guard the import time of the pipeline scripts.")
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--repeat", type=int, default=3, help="report the fastest of N runs")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = [check(m, args.repeat, args.budget_ms) for m in args.modules]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            status = "ok" if r["ok"] else "FAIL"
+            print(f"{r['module']:<20} {r['cumulative_ms']:>8.2f} ms  {status}")
+            if r["heavy_imports"]:
+                print(f"    heavy imports: {', '.join(r['heavy_imports'])}")
+
+    sys.exit(0 if all(r["ok"] for r in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
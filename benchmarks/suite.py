@@ -0,0 +1,357 @@
+# Reproducible benchmarks for the pipeline stages and API endpoints.
+#
+# Synthetic bars (see synthetic.py) are loaded into a scratch database and
+# each stage is timed on them:
+#
+#   upload            alpaca.upload_to_db for every ticker and bot
+#   detect            anomaly_detection.detect_anomalies + upload_to_db
+#   global_distance   dtw.calc_global_distance(ticker, bot)
+#   anomaly_distance  dtw.calc_anomaly_distance(ticker, bot)
+#   GET <endpoint>    the Flask routes through the test client
+#
+# On TimescaleDB the bot scorecards are refreshed (untimed) after the
+# distance stages, so /api/v1/bot-overview reads materialised buckets.
+#
+# The database is either an existing Postgres/TimescaleDB you point it at
+# (--dsn or BENCH_DSN, e.g. a local `timescale/timescaledb-ha` container), or
+# a throwaway local PostgreSQL started with testing.postgresql (--embedded).
+# Without the timescaledb and timescaledb_toolkit extensions, the
+# Timescale-only statements of schema.sql are skipped, and so is the
+# /api/v1/bot-overview benchmark, which reads a continuous aggregate. The
+# database is truncated between runs, so never point it at real data.
+#
+#   python benchmarks/suite.py run --lengths 500,2000 --tickers 2 -o before.json
+#   python benchmarks/suite.py run --embedded -o after.json
+#   python benchmarks/suite.py compare before.json after.json
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+from synthetic import generate_universe, write_bars  # noqa: E402
+
+# schema.sql statements that need the timescaledb or timescaledb_toolkit extension
+TIMESCALE_ONLY = ("create_hypertable", "timescaledb", "bot_scorecard")
+
+TABLES = ("stocks", "anomaly", "pipeline_watermark")
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = bool(subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def start_backend(args):
+    dsn = args.dsn or os.getenv("BENCH_DSN")
+    if dsn and not args.embedded:
+        return dsn, None
+    try:
+        import testing.postgresql
+    except ImportError:
+        raise SystemExit(
+            "No --dsn/BENCH_DSN given and testing.postgresql is not installed; "
+            "install it (and a local PostgreSQL) to use --embedded"
+        )
+    server = testing.postgresql.Postgresql()
+    return server.url(), server
+
+
+# Write the schema this backend supports into the work directory and apply it
+def prepare_schema(conn, workdir):
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT count(*) FROM pg_available_extensions WHERE name IN ('timescaledb', 'timescaledb_toolkit');"
+    )
+    timescale = cursor.fetchone()[0] == 2
+
+    with open(os.path.join(ROOT, "schema.sql")) as f:
+        schema = f.read()
+
+    if timescale:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS timescaledb;")
+    else:
+        schema = "\n".join(line for line in schema.splitlines() if not line.lstrip().startswith("--"))
+        statements = [
+            s.strip() for s in schema.split(";")
+            if s.strip() and not any(word in s for word in TIMESCALE_ONLY)
+        ]
+        schema = ";\n\n".join(statements) + ";\n"
+
+    with open(os.path.join(workdir, "schema.sql"), "w") as f:
+        f.write(schema)
+    cursor.execute(schema)
+    conn.commit()
+    cursor.close()
+    return "timescaledb" if timescale else "postgres"
+
+
+# A stock_info.csv for /api/v1/stocks: the synthetic tickers plus filler rows
+def write_stock_info(workdir, tickers, filler=5000):
+    os.makedirs(os.path.join(workdir, "static"), exist_ok=True)
+    with open(os.path.join(workdir, "static", "stock_info.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Ticker", "Name"])
+        for ticker in tickers:
+            writer.writerow([ticker, f"Synthetic {ticker}"])
+        for i in range(filler):
+            writer.writerow([f"F{i:05d}", f"Filler {i}"])
+
+
+# Materialise the bot_scorecard_daily continuous aggregate. The stages leave
+# a read transaction open and the refresh cannot run inside one.
+def refresh_scorecards(conn):
+    conn.commit()
+    conn.autocommit = True
+    try:
+        cursor = conn.cursor()
+        cursor.execute("CALL refresh_continuous_aggregate('bot_scorecard_daily', NULL, NULL);")
+        cursor.close()
+    finally:
+        conn.autocommit = False
+
+
+def truncate(conn, *tables):
+    cursor = conn.cursor()
+    cursor.execute(f"TRUNCATE {', '.join(tables)};")
+    conn.commit()
+    cursor.close()
+
+
+# Time `fn` `repeat` times (running `setup` untimed before each call) with
+# the stages' progress output silenced
+def measure(fn, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - started)
+    return {
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "mean_s": statistics.fmean(times),
+        "runs": times,
+    }
+
+
+def run_length(conn, workdir, length, args, client, backend):
+    import alpaca
+    import anomaly_detection
+    import dtw
+    import similarity
+
+    universe = generate_universe(args.tickers, length, args.end, seed=args.seed)
+    tickers = [t for t in universe if not t.endswith("-random")]
+    files = {
+        t: write_bars(bars, os.path.join(workdir, f"{t}_bars.json"))
+        for t, bars in universe.items()
+    }
+
+    results = []
+
+    def record(stage, timing, rows):
+        results.append({"stage": stage, "length": length, "tickers": len(tickers), "rows": rows, **timing})
+        print(f"  {stage:<50} length={length:<7} median={timing['median_s']:.4f}s", file=sys.stderr)
+
+    truncate(conn, *TABLES)
+    similarity.reset_index()
+
+    def upload_all():
+        for t, filename in files.items():
+            alpaca.upload_to_db(filename, t)
+
+    record("upload", measure(upload_all, args.repeat, setup=lambda: truncate(conn, "stocks")),
+           rows=length * len(files))
+
+    def detect_all():
+        for t in tickers:
+            points = anomaly_detection.detect_anomalies(t, show=False)
+            anomaly_detection.upload_to_db(points, t)
+
+    record("detect", measure(detect_all, args.repeat, setup=lambda: truncate(conn, "anomaly")),
+           rows=length * len(tickers))
+
+    def global_distance():
+        for t in tickers:
+            dtw.calc_global_distance(t, f"{t}-random")
+
+    record("global_distance", measure(global_distance, args.repeat), rows=length * len(tickers))
+
+    def anomaly_distance():
+        for t in tickers:
+            dtw.calc_anomaly_distance(t, f"{t}-random", plot=False)
+
+    record("anomaly_distance", measure(anomaly_distance, args.repeat), rows=length * len(tickers))
+
+    if backend == "timescaledb":
+        refresh_scorecards(conn)
+
+    endpoints = [
+        "/api/v1/stocks?query=SYN",
+        "/api/v1/stocks?query=SYN&format=columns",
+        f"/api/v1/stocks/{tickers[0]}",
+        f"/api/v1/similar?ticker={tickers[0]}&k=10",
+    ]
+    if backend == "timescaledb":
+        endpoints += [
+            f"/api/v1/bot-overview?bot={tickers[0]}-random&time_range=1y",
+            f"/api/v1/bot-overview?bot={tickers[0]}-random&time_range=1y&format=columns",
+        ]
+    for path in endpoints:
+        def request(path=path):
+            response = client.get(path, headers={"Accept-Encoding": "gzip, br"})
+            if response.status_code != 200:
+                raise RuntimeError(f"GET {path} returned {response.status_code}")
+
+        record(f"GET {path}", measure(request, args.repeat), rows=length)
+
+    return results
+
+
+def run(args):
+    lengths = [int(n) for n in args.lengths.split(",")]
+    dsn, server = start_backend(args)
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="vectorbench-")
+
+    # Stage modules connect through db.py, which reads TS_DSN on first use
+    os.environ["TS_DSN"] = dsn
+
+    try:
+        import db
+
+        conn = db.get_conn()
+        backend = prepare_schema(conn, workdir)
+
+        universe = generate_universe(args.tickers, 1, args.end, seed=args.seed)
+        write_stock_info(workdir, universe)
+
+        # app.py reads schema.sql and static/ relative to the working directory
+        os.chdir(workdir)
+        from app import app
+
+        results = []
+        with app.test_client() as client:
+            for length in lengths:
+                print(f"length={length}, tickers={args.tickers}, backend={backend}", file=sys.stderr)
+                results.extend(run_length(conn, workdir, length, args, client, backend))
+
+        truncate(conn, *TABLES)
+        db.close_conn()
+    finally:
+        os.chdir(cwd)
+        if server is not None:
+            server.stop()
+
+    commit, dirty = git_revision()
+    report = {
+        "meta": {
+            "commit": commit,
+            "dirty": dirty,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": backend,
+            "lengths": lengths,
+            "tickers": args.tickers,
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "end": args.end.isoformat(),
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    before = {(r["stage"], r["length"]): r for r in baseline["results"]}
+    regressions = 0
+
+    print(f"baseline  {baseline['meta'].get('commit')}")
+    print(f"candidate {candidate['meta'].get('commit')}\n")
+    print(f"{'stage':<50} {'length':>7} {'before':>10} {'after':>10} {'ratio':>7}")
+    for r in candidate["results"]:
+        old = before.get((r["stage"], r["length"]))
+        if old is None:
+            continue
+        ratio = r["median_s"] / old["median_s"] if old["median_s"] else float("inf")
+        flag = ""
+        if ratio > args.fail_above:
+            regressions += 1
+            flag = "  slower"
+        print(
+            f"{r['stage']:<50} {r['length']:>7} {old['median_s']:>10.4f} "
+            f"{r['median_s']:>10.4f} {ratio:>7.2f}{flag}"
+        )
+
+    sys.exit(1 if regressions else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages and API endpoints.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks and emit JSON results")
+    run_parser.add_argument("--lengths", default="500,2000", help="comma-separated bars per series")
+    run_parser.add_argument("--tickers", type=int, default=2, help="synthetic tickers (each gets a bot variant)")
+    run_parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--end", type=lambda s: datetime.fromisoformat(s.replace("Z", "+00:00")),
+                            default=datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0),
+                            help="timestamp of the last bar (default: start of today, UTC)")
+    run_parser.add_argument("--dsn", help="Postgres/TimescaleDB to run against (default: $BENCH_DSN)")
+    run_parser.add_argument("--embedded", action="store_true", help="start a throwaway local PostgreSQL")
+    run_parser.add_argument("-o", "--output", help="write results to this file instead of stdout")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--fail-above", type=float, default=1.2,
+                                help="exit non-zero if any median is this many times slower")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
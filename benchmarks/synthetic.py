@@ -0,0 +1,84 @@
+# Deterministic synthetic OHLCV bars for the benchmarks.
+#
+# Bars use the same shape as the Alpaca bars API (t, o, h, l, c, v, n, vw), so
+# they can be written to a JSON file and loaded with alpaca.upload_to_db. The
+# generator only uses the standard library `random` module with explicit
+# seeds, so the same arguments give the same series on every machine.
+
+import json
+import random
+import zlib
+from datetime import datetime, timedelta, timezone
+
+BAR_INTERVAL = timedelta(hours=1)
+
+
+def _seed(*parts):
+    return zlib.crc32("/".join(str(p) for p in parts).encode())
+
+
+def _bar(t, o, c, rng, volume):
+    h = max(o, c) * (1 + abs(rng.gauss(0, 0.002)))
+    l = min(o, c) * (1 - abs(rng.gauss(0, 0.002)))
+    v = max(1, int(volume * rng.lognormvariate(0, 0.3)))
+    return {
+        "t": t.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "o": round(o, 4),
+        "h": round(h, 4),
+        "l": round(l, 4),
+        "c": round(c, 4),
+        "v": v,
+        "n": max(1, v // 100),
+        "vw": round((h + l + c) / 3, 4),
+    }
+
+
+# `length` hourly bars for `ticker` ending at `end`: a geometric random walk
+# with occasional jumps, so IsolationForest has something to find
+def generate_bars(ticker, length, end, seed=0, start_price=100.0, volatility=0.01, jump_rate=0.02):
+    rng = random.Random(_seed(ticker, length, seed))
+    start = end - BAR_INTERVAL * length
+
+    bars = []
+    price = start_price
+    for i in range(length):
+        ret = rng.gauss(0, volatility)
+        if rng.random() < jump_rate:
+            ret += rng.choice((-1, 1)) * rng.uniform(0.03, 0.08)
+        close = max(0.01, price * (1 + ret))
+        bars.append(_bar(start + BAR_INTERVAL * i, price, close, rng, volume=50000))
+        price = close
+    return bars
+
+
+# A "bot" that tracks `bars` with multiplicative noise and occasional misses,
+# like the TSLA-random series the DTW stage compares against
+def perturb_bars(bars, bot, seed=0, noise=0.01, miss_rate=0.03):
+    rng = random.Random(_seed(bot, len(bars), seed))
+
+    perturbed = []
+    for bar in bars:
+        factor = 1 + rng.gauss(0, noise)
+        if rng.random() < miss_rate:
+            factor += rng.choice((-1, 1)) * rng.uniform(0.02, 0.05)
+        t = datetime.strptime(bar["t"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+        perturbed.append(_bar(t, bar["o"] * factor, bar["c"] * factor, rng, volume=bar["v"]))
+    return perturbed
+
+
+# {ticker: bars} for `count` tickers (SYN0, SYN1, ...) plus a "<ticker>-random"
+# bot variant of each
+def generate_universe(count, length, end, seed=0):
+    universe = {}
+    for i in range(count):
+        ticker = f"SYN{i}"
+        bars = generate_bars(ticker, length, end, seed, start_price=50.0 + 25 * i)
+        universe[ticker] = bars
+        universe[f"{ticker}-random"] = perturb_bars(bars, f"{ticker}-random", seed)
+    return universe
+
+
+def write_bars(bars, filename):
+    with open(filename, "w") as f:
+        json.dump(bars, f)
+    return filename
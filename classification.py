@@ -1,47 +1,57 @@
-import requests
 import traceback
-from openai import OpenAI
 import os 
 import json
-import psycopg2
-
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except ImportError:
-    pass 
-
-TS_HOST = os.getenv('TS_HOST')
-TS_PORT = os.getenv('TS_PORT', 5432)
-TS_NAME = os.getenv('TS_DATABASE')
-TS_USER = os.getenv('TS_USER')
-TS_PASSWORD = os.getenv('TS_PASSWORD')
-
-conn = psycopg2.connect(
-        host=TS_HOST,
-        port=TS_PORT,
-        dbname=TS_NAME,
-        user=TS_USER,
-        password=TS_PASSWORD
-    )
-cursor = conn.cursor()
+from db import bulk_update, get_conn
+import metrics
+
+# requests and openai are imported on first use, and the database connection
+# and API clients are created lazily, so importing this module stays cheap.
 
 
 EODHD_API_KEY = os.getenv("EODHD_API_KEY", None)
 OPENAI_API_KEY = os.getenv("YOUR_OPENAI_API_KEY", None)
 
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY", None)
 
-deepseek_client = OpenAI(api_key=os.getenv("DEEPSEEK_API_KEY", None), base_url="https://api.deepseek.com")
-
 GPT_MODEL = "gpt-4o-2024-08-06"
 
 REASON_MODEL = "deepseek-reasoner"
 
+_clients = {}
+
+def get_openai_client():
+    if 'openai' not in _clients:
+        from openai import OpenAI
+        _clients['openai'] = OpenAI(api_key=OPENAI_API_KEY)
+    return _clients['openai']
+
+def get_deepseek_client():
+    if 'deepseek' not in _clients:
+        from openai import OpenAI
+        _clients['deepseek'] = OpenAI(api_key=DEEPSEEK_API_KEY, base_url="https://api.deepseek.com")
+    return _clients['deepseek']
+
+
+# Call the chat completions API, recording latency, outcome and token usage
+def create_completion(client, model, **kwargs):
+    with metrics.timer("llm_request_seconds", model=model):
+        try:
+            response = client.chat.completions.create(model=model, **kwargs)
+        except Exception:
+            metrics.inc("llm_requests_total", model=model, status="error")
+            raise
+    metrics.inc("llm_requests_total", model=model, status="ok")
+
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        metrics.inc("llm_tokens_total", usage.prompt_tokens or 0, model=model, kind="prompt")
+        metrics.inc("llm_tokens_total", usage.completion_tokens or 0, model=model, kind="completion")
+    return response
+
 
 def get_articles(ticker, date):
+    import requests
+
     try:
         url = f"https://eodhd.com/api/news"
         params = {
@@ -129,8 +139,9 @@ def classify(date, ticker, articles, stock_del):
     }
 
     try:
-        response = openai_client.chat.completions.create(
-            model=GPT_MODEL,
+        response = create_completion(
+            get_openai_client(),
+            GPT_MODEL,
             messages=[sys_msg, usr_msg],
             max_tokens=100,
             temperature=1.00,
@@ -193,8 +204,9 @@ def deepseek(data):
         for score, entry in data
     ]
 
-    response = deepseek_client.chat.completions.create(
-        model="deepseek-reasoner",
+    response = create_completion(
+        get_deepseek_client(),
+        REASON_MODEL,
         messages=[explanation_message] + data_messages,
     )
 
@@ -204,9 +216,15 @@ def deepseek(data):
     return reasoning_content, content
 
 
-def load_anomalies_from_db(ticker):
-    query = "SELECT trade_time, distance FROM anomaly WHERE ticker = %s ORDER BY trade_time;"
-    cursor.execute(query, (ticker,))
+def load_anomalies_from_db(ticker, since=None):
+    query = "SELECT trade_time, distance FROM anomaly WHERE ticker = %s"
+    params = [ticker]
+    if since is not None:
+        query += " AND trade_time > %s"
+        params.append(since)
+    query += " ORDER BY trade_time;"
+    cursor = get_conn().cursor()
+    cursor.execute(query, params)
     results = cursor.fetchall()
 
     anomalies = [
@@ -218,30 +236,28 @@ def load_anomalies_from_db(ticker):
 
 def update_anomalies_in_db(classification_data, ticker):
     rows = [
-        (entry['classification'], entry['explaination'], entry['trade_time'], ticker)
+        (entry['trade_time'], ticker, entry['classification'], entry['explanation'])
         for entry in classification_data
     ]
 
-    query = """
-    UPDATE anomaly
-    SET classification = %s, explaination = %s
-    WHERE trade_time = %s AND ticker = %s;
-    """
-
-    cursor.executemany(query, rows)
+    # The explanation is stored in the anomaly table's descr column
+    conn = get_conn()
+    updated = bulk_update(conn, 'anomaly', ('trade_time', 'ticker', 'classification', 'descr'), rows)
     conn.commit()
-    print(f"Updated {len(rows)} anomalies in the database.")
-
-def main():
-    # Define the ticker
-    ticker = "TSLA"
+    print(f"Updated {updated} anomalies in the database.")
+    return updated
 
+# Classify every anomaly of `ticker` (after `since` when given) and store the
+# results. Anomalies that could not be classified are left untouched so a
+# later run retries them; their trade times are returned as `failed`.
+def classify_anomalies(ticker, since=None):
     # Load anomalies from the database
-    anomalies = load_anomalies_from_db(ticker)
+    anomalies = load_anomalies_from_db(ticker, since)
 
     # Initialize lists for valid classification data
     classification_data = []
     valid_dels = []
+    failed = []
 
     # Loop through each anomaly
     for anomaly in anomalies:
@@ -270,16 +286,27 @@ def main():
             valid_dels.append(stock_del)
         except Exception as e:
             print(f"Error classifying anomaly at {trade_time}: {e}")
-            classification_data.append({
-                "classification": "Error",
-                "explanation": "Classification failed.",
-                "trade_time": trade_time
-            })
-            valid_dels.append(stock_del)
+            failed.append(trade_time)
+
+    if classification_data:
+        update_anomalies_in_db(classification_data, ticker)
+
+    return classification_data, valid_dels, failed
+
+def main():
+    # Define the ticker
+    ticker = "TSLA"
+
+    classification_data, valid_dels, failed = classify_anomalies(ticker)
+    if failed:
+        print(f"{len(failed)} anomalies could not be classified and were left for a later run.")
 
     # Pass only classification and explanation into deepseek
     try:
-        feedback = deepseek(valid_dels, classification_data)
+        feedback = deepseek([
+            (score, {"category": entry['classification'], "explanation": entry['explanation']})
+            for score, entry in zip(valid_dels, classification_data)
+        ])
         print("DeepSeek Feedback:", feedback)
     except Exception as e:
         print(f"Error during DeepSeek feedback generation: {e}")
@@ -1,6 +1,17 @@
+import io
+import os
 import psycopg2
+import psycopg2.extensions
+from psycopg2 import sql
 from configparser import ConfigParser
-from flask import g
+
+import metrics
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
 
 def config(filename='database.ini', section='postgresql'):
     parser = ConfigParser()
@@ -16,20 +27,239 @@ def config(filename='database.ini', section='postgresql'):
 
     return db
 
+# Connection parameters for the scripts, taken from the TS_* environment variables
+def env_config():
+    dsn = os.getenv('TS_DSN')
+    if dsn:
+        return {'dsn': dsn}
+    return {
+        'host': os.getenv('TS_HOST'),
+        'port': os.getenv('TS_PORT', 5432),
+        'dbname': os.getenv('TS_DATABASE'),
+        'user': os.getenv('TS_USER'),
+        'password': os.getenv('TS_PASSWORD'),
+    }
+
+# Cursor that records the latency of every statement, labelled by its verb
+class TimedCursor(psycopg2.extensions.cursor):
+    def _statement(self, query):
+        if isinstance(query, sql.Composable):
+            query = query.as_string(self)
+        if isinstance(query, bytes):
+            query = query.decode(errors='replace')
+        words = query.split(None, 1)
+        return words[0].upper() if words else 'EMPTY'
+
+    def execute(self, query, vars=None):
+        statement = self._statement(query)
+        metrics.inc('db_queries_total', statement=statement)
+        with metrics.timer('db_query_seconds', statement=statement):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        statement = self._statement(query)
+        metrics.inc('db_queries_total', statement=statement)
+        with metrics.timer('db_query_seconds', statement=statement):
+            return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        metrics.inc('db_queries_total', statement='COPY')
+        with metrics.timer('db_query_seconds', statement='COPY'):
+            return super().copy_expert(sql, file, size)
+
+def connect():
+    return psycopg2.connect(**env_config(), cursor_factory=TimedCursor)
+
+# Connection parameters for the API: TS_DSN when set, else database.ini,
+# else the TS_* environment variables
+def app_config():
+    if os.getenv('TS_DSN'):
+        return env_config()
+    try:
+        return config()
+    except Exception:
+        return env_config()
+
+# Shared per-process connection, opened on first use so importing a script
+# (or spawning a pool worker) never touches the database
+_conn = None
+
+def get_conn():
+    global _conn
+    if _conn is None or _conn.closed:
+        _conn = connect()
+    return _conn
+
+def close_conn():
+    global _conn
+    if _conn is not None and not _conn.closed:
+        _conn.close()
+    _conn = None
+
 def get_db():
+    from flask import g
+
     if 'db' not in g:
         try:
-            params = config()
-            g.db = psycopg2.connect(**params)
+            params = app_config()
+            g.db = psycopg2.connect(**params, cursor_factory=TimedCursor)
         except (Exception, psycopg2.DatabaseError) as error:
             print(error)
             g.db = None
     return g.db
 
 def close_db(e=None):
+    from flask import g
+
     db = g.pop('db', None)
     if db is not None:
         db.close()
     if e is not None:
         print(e)
 
+# Arbitrary key for the advisory lock that serialises schema migrations
+SCHEMA_LOCK_KEY = 7170301
+
+# Extensions schema.sql can depend on; those the file mentions must be
+# available on the server
+SCHEMA_EXTENSIONS = ('timescaledb', 'timescaledb_toolkit')
+
+# Run schema.sql in one transaction. The advisory lock makes concurrent
+# callers (several API processes starting at once) run it one after another,
+# since concurrent IF NOT EXISTS DDL can still collide in the catalogs.
+def apply_schema(conn, filename='schema.sql'):
+    with open(filename) as f:
+        schema = f.read()
+    needed = [name for name in SCHEMA_EXTENSIONS if name in schema]
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT name FROM pg_available_extensions WHERE name = ANY(%s::text[]);',
+        (needed,)
+    )
+    available = {row[0] for row in cursor.fetchall()}
+    missing = [name for name in needed if name not in available]
+    if missing:
+        cursor.close()
+        conn.rollback()
+        raise RuntimeError(
+            f'schema.sql needs the PostgreSQL extension(s) {", ".join(missing)}, which the '
+            'database server does not provide. Use a TimescaleDB image that ships the '
+            'toolkit (e.g. timescale/timescaledb-ha) or install timescaledb-toolkit.'
+        )
+    cursor.execute('SELECT pg_advisory_xact_lock(%s);', (SCHEMA_LOCK_KEY,))
+    cursor.execute(schema)
+    conn.commit()
+    cursor.close()
+
+# Cache of (connection DSN, table name) -> set of column names, filled from
+# information_schema for the connection's current schema
+_table_columns = {}
+
+def table_columns(conn, table):
+    key = (conn.dsn, table)
+    if key not in _table_columns:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = %s;",
+            (table,)
+        )
+        columns = {row[0] for row in cursor.fetchall()}
+        cursor.close()
+        if not columns:
+            raise ValueError(f'Table {table} not found in the database schema')
+        _table_columns[key] = columns
+    return _table_columns[key]
+
+# Format a single value for COPY ... FROM STDIN (text format)
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+# Bulk-write rows into `table` with one COPY and one set-based statement.
+# `rows` are tuples ordered like `columns`; `key` names the columns used to
+# match existing rows and must be a subset of `columns`. With upsert=False the
+# rows are applied as UPDATE ... FROM, otherwise as INSERT ... ON CONFLICT DO
+# UPDATE. Returns the number of affected rows; the caller commits.
+def bulk_update(conn, table, columns, rows, key=('trade_time', 'ticker'), upsert=False):
+    columns = list(columns)
+    key = list(key)
+
+    unknown = [c for c in columns if c not in table_columns(conn, table)]
+    if unknown:
+        raise ValueError(f'Unknown columns for table {table}: {", ".join(unknown)}')
+    missing_key = [c for c in key if c not in columns]
+    if missing_key:
+        raise ValueError(f'Key columns missing from columns: {", ".join(missing_key)}')
+    values = [c for c in columns if c not in key]
+    if not values:
+        raise ValueError('No columns to update besides the key')
+
+    rows = list(rows)
+    if not rows:
+        return 0
+
+    buffer = io.StringIO()
+    for row in rows:
+        if len(row) != len(columns):
+            raise ValueError(f'Expected {len(columns)} values per row, got {len(row)}')
+        buffer.write('\t'.join(_copy_value(v) for v in row))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    # Always a temp table: an unqualified name could resolve to (and drop) a
+    # permanent table of the same name on the search_path
+    staging = sql.Identifier('pg_temp', f'_bulk_{table}')
+    target = sql.Identifier(table)
+    column_list = sql.SQL(', ').join(map(sql.Identifier, columns))
+
+    cursor = conn.cursor()
+    cursor.execute(sql.SQL('DROP TABLE IF EXISTS {};').format(staging))
+    cursor.execute(
+        sql.SQL('CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA;')
+        .format(staging, column_list, target)
+    )
+    cursor.copy_expert(
+        sql.SQL('COPY {} ({}) FROM STDIN;').format(staging, column_list).as_string(conn),
+        buffer
+    )
+
+    if upsert:
+        query = sql.SQL(
+            'INSERT INTO {target} ({columns}) SELECT {columns} FROM {staging} '
+            'ON CONFLICT ({key}) DO UPDATE SET {assignments};'
+        ).format(
+            target=target,
+            columns=column_list,
+            staging=staging,
+            key=sql.SQL(', ').join(map(sql.Identifier, key)),
+            assignments=sql.SQL(', ').join(
+                sql.SQL('{0} = EXCLUDED.{0}').format(sql.Identifier(c)) for c in values
+            ),
+        )
+    else:
+        query = sql.SQL(
+            'UPDATE {target} AS t SET {assignments} FROM {staging} AS s WHERE {match};'
+        ).format(
+            target=target,
+            staging=staging,
+            assignments=sql.SQL(', ').join(
+                sql.SQL('{0} = s.{0}').format(sql.Identifier(c)) for c in values
+            ),
+            match=sql.SQL(' AND ').join(
+                sql.SQL('t.{0} = s.{0}').format(sql.Identifier(c)) for c in key
+            ),
+        )
+
+    cursor.execute(query)
+    affected = cursor.rowcount
+    cursor.execute(sql.SQL('DROP TABLE {};').format(staging))
+    cursor.close()
+    return affected
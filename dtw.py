@@ -1,38 +1,28 @@
 import math
-import numpy as np
-from fastdtw import fastdtw
-import os
-from dotenv import load_dotenv
-import pandas as pd
-import psycopg2
-import matplotlib.pyplot as plt
-from psycopg2.extras import execute_values
-
-
-
-# Load environment variables
-load_dotenv()
-
-# Database connection parameters
-TS_HOST = os.getenv('TS_HOST')
-TS_PORT = os.getenv('TS_PORT', 5432)
-TS_NAME = os.getenv('TS_DATABASE')
-TS_USER = os.getenv('TS_USER')
-TS_PASSWORD = os.getenv('TS_PASSWORD')
-
-# Establish connection to the database
-conn = psycopg2.connect(
-    host=TS_HOST,
-    port=TS_PORT,
-    dbname=TS_NAME,
-    user=TS_USER,
-    password=TS_PASSWORD
-)
-cursor = conn.cursor()
+import time
+from db import bulk_update, get_conn
+import metrics
+
+# numpy, pandas, fastdtw and matplotlib are imported inside the functions that
+# use them, and the database connection is opened on first query, so importing
+# this module stays cheap.
+
+# numpy, loaded by _numpy() on first use
+_np = None
+
+def _numpy():
+    global _np
+    if _np is None:
+        import numpy
+        _np = numpy
+    return _np
 
 # Load bars from the database for a specific ticker
 def load_bars_from_db(ticker):
+    import pandas as pd
+
     query = "SELECT * FROM stocks WHERE ticker = %s ORDER BY trade_time;"
+    cursor = get_conn().cursor()
     cursor.execute(query, (ticker,))
     results = cursor.fetchall()
 
@@ -43,10 +33,16 @@ def load_bars_from_db(ticker):
     df = df.drop(columns=['id', 'ticker'])
     return df
 
-# Load anomalies from the anomaly table
-def load_anomalies_from_db(ticker):
-    query = "SELECT trade_time FROM anomaly WHERE ticker = %s ORDER BY trade_time;"
-    cursor.execute(query, (ticker,))
+# Load anomalies from the anomaly table, optionally only those after `since`
+def load_anomalies_from_db(ticker, since=None):
+    query = "SELECT trade_time FROM anomaly WHERE ticker = %s"
+    params = [ticker]
+    if since is not None:
+        query += " AND trade_time > %s"
+        params.append(since)
+    query += " ORDER BY trade_time;"
+    cursor = get_conn().cursor()
+    cursor.execute(query, params)
     results = cursor.fetchall()
 
     # Extract trade_time values as anomaly indices
@@ -55,7 +51,7 @@ def load_anomalies_from_db(ticker):
 
 # Convert a single bar to a feature vector
 def bar_to_vector(bar):
-    return np.array([
+    return _numpy().array([
         bar["o"],
         bar["h"],
         bar["l"],
@@ -65,54 +61,62 @@ def bar_to_vector(bar):
         bar["vw"]
     ], dtype=float)
 
-# Calculate the angle-based distance between two vectors
-def angle_distance(vec_a, vec_b):
-    norm_a = np.linalg.norm(vec_a)
-    norm_b = np.linalg.norm(vec_b)
-    if norm_a < 1e-12 or norm_b < 1e-12:
-        return 0.0
+# Build the angle-based distance between two vectors. numpy is bound once here
+# because fastdtw calls the distance for every cell of the DTW matrix.
+def make_angle_distance():
+    np = _numpy()
+    norm = np.linalg.norm
+    dot = np.dot
+
+    def angle_distance(vec_a, vec_b):
+        norm_a = norm(vec_a)
+        norm_b = norm(vec_b)
+        if norm_a < 1e-12 or norm_b < 1e-12:
+            return 0.0
 
-    dot_product = np.dot(vec_a, vec_b)
-    cos_value = dot_product / (norm_a * norm_b)
-    # Clamp to avoid floating precision issues outside [-1, 1]
-    cos_value = max(min(cos_value, 1.0), -1.0)
-    return math.acos(cos_value)
+        dot_product = dot(vec_a, vec_b)
+        cos_value = dot_product / (norm_a * norm_b)
+        # Clamp to avoid floating precision issues outside [-1, 1]
+        cos_value = max(min(cos_value, 1.0), -1.0)
+        return math.acos(cos_value)
+
+    return angle_distance
 
 # Calculate the global distance using FastDTW
 def calc_global_distance(ticker1, ticker2):
+    from fastdtw import fastdtw
+
     bars1 = load_bars_from_db(ticker1)
     bars2 = load_bars_from_db(ticker2)
 
     vectors1 = bars1.apply(bar_to_vector, axis=1).tolist()
     vectors2 = bars2.apply(bar_to_vector, axis=1).tolist()
+    angle_distance = make_angle_distance()
 
-    distance, path = fastdtw(vectors1, vectors2, dist=angle_distance)
+    with metrics.timer("dtw_seconds", kind="global"):
+        distance, path = fastdtw(vectors1, vectors2, dist=angle_distance)
     print(f"Raw DTW Distance = {distance}")
 
 def update_anomalies_in_db(anomalies, ticker1, ticker2):
     rows = [
-        (ticker2, distance, anomaly_time, ticker1)  # Values for bot, distance, trade_time, and ticker
+        (anomaly_time, ticker1, ticker2, distance)  # Values for trade_time, ticker, bot, and distance
         for anomaly_time, distance in anomalies
     ]
 
-    query = """
-    UPDATE anomaly
-    SET bot = %s, distance = %s
-    WHERE trade_time = %s AND ticker = %s;
-    """
-
-    cursor.executemany(query, rows)
+    conn = get_conn()
+    updated = bulk_update(conn, 'anomaly', ('trade_time', 'ticker', 'bot', 'distance'), rows)
     conn.commit()
-    print(f"Updated {len(rows)} anomalies in the database.")
+    print(f"Updated {updated} anomalies in the database.")
+    return updated
 
 
 # Calculate anomaly distances using Euclidean distance with nearest points
-def calc_anomaly_distance(ticker1, ticker2):
+def calc_anomaly_distance(ticker1, ticker2, since=None, plot=True):
     bars1 = load_bars_from_db(ticker1)
     bars2 = load_bars_from_db(ticker2)
 
-    # Load all anomaly times
-    anomaly_times = load_anomalies_from_db(ticker1)
+    # Load anomaly times (only those after `since` when given)
+    anomaly_times = load_anomalies_from_db(ticker1, since)
 
     # Extract trade times and closing prices for both tickers
     times1 = bars1['trade_time'].tolist()
@@ -122,6 +126,7 @@ def calc_anomaly_distance(ticker1, ticker2):
 
     anomaly_data = []
 
+    started = time.perf_counter()
     for anomaly_time in anomaly_times:
         if anomaly_time in times1:
             anomaly_idx = times1.index(anomaly_time)
@@ -140,15 +145,21 @@ def calc_anomaly_distance(ticker1, ticker2):
         # Calculate Euclidean distance
         distance = abs(anomaly_price - nearest_price)
         anomaly_data.append((anomaly_time, distance))
+    metrics.observe("dtw_seconds", time.perf_counter() - started, kind="anomaly")
 
     # Insert anomalies into the database
     update_anomalies_in_db(anomaly_data, ticker1, ticker2)
 
     # Plot the charts with anomalies
-    plot_with_anomalies(bars1, bars2, [anomaly[0] for anomaly in anomaly_data])
+    if plot:
+        plot_with_anomalies(bars1, bars2, [anomaly[0] for anomaly in anomaly_data])
+
+    return anomaly_data
 
 # Plot the comparison with anomalies highlighted
 def plot_with_anomalies(bars1, bars2, anomalies):
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(12, 6))
     plt.plot(
         bars1['trade_time'], bars1['c'], label="Ticker 1 (Closing Price)", color="blue", alpha=0.7
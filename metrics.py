@@ -0,0 +1,215 @@
+# In-process instrumentation for the hot paths.
+#
+# Counters and histograms live in a per-process registry and can be exported
+# in the Prometheus text format (the /metrics endpoint), as a JSON snapshot
+# (one structured log line per batch run), or merged across pool workers.
+# profile() optionally captures a cProfile dump for a single request or stage.
+#
+#   with metrics.timer("dtw_seconds", kind="global"):
+#       ...
+#   metrics.inc("llm_tokens_total", usage.prompt_tokens, model=m, kind="prompt")
+
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# name -> (type, help); names not listed here are exported as untyped
+METRICS = {
+    "db_query_seconds": ("histogram", "Database query latency"),
+    "db_queries_total": ("counter", "Database queries executed"),
+    "alpaca_page_seconds": ("histogram", "Alpaca bars API page fetch time"),
+    "alpaca_bars_total": ("counter", "Bars fetched from the Alpaca API"),
+    "isolation_forest_fit_seconds": ("histogram", "IsolationForest fit time"),
+    "dtw_seconds": ("histogram", "DTW and anomaly distance computation time"),
+    "llm_request_seconds": ("histogram", "LLM call latency"),
+    "llm_requests_total": ("counter", "LLM calls"),
+    "llm_tokens_total": ("counter", "LLM tokens used"),
+    "http_request_seconds": ("histogram", "API request latency"),
+    "http_requests_total": ("counter", "API requests served"),
+    "pipeline_stage_seconds": ("histogram", "Pipeline stage run time"),
+    "stream_bars_total": ("counter", "Bars received from the stream"),
+    "stream_stale_bars_total": ("counter", "Duplicate or out-of-order stream bars skipped"),
+    "stream_anomalies_total": ("counter", "Anomalies detected in the stream"),
+    "stream_score_seconds": ("histogram", "Online scoring time per bar"),
+    "stream_flush_seconds": ("histogram", "Micro-batch write time"),
+    "stream_detection_lag_seconds": ("histogram", "Time from bar timestamp to anomaly detection"),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0}
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                hist["buckets"][i] += 1
+        hist["count"] += 1
+        hist["sum"] += value
+
+
+# Observe the duration of the block (in seconds) into histogram `name`
+@contextmanager
+def timer(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+# Record the latency and count of one API request. `request` is a Flask or
+# Quart request and `started` its time.perf_counter() at the start.
+def observe_request(request, status, started):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    labels = {"method": request.method, "endpoint": endpoint, "status": status}
+    observe("http_request_seconds", time.perf_counter() - started, **labels)
+    inc("http_requests_total", **labels)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+# JSON-serialisable copy of every metric
+def snapshot():
+    with _lock:
+        return {
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in _counters.items()
+            ],
+            "histograms": [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "buckets": list(hist["buckets"]),
+                    "count": hist["count"],
+                    "sum": hist["sum"],
+                }
+                for (name, labels), hist in _histograms.items()
+            ],
+        }
+
+
+# Add a snapshot taken in another process (e.g. a pool worker) to this registry
+def merge(snap):
+    for counter in snap["counters"]:
+        inc(counter["name"], counter["value"], **counter["labels"])
+    with _lock:
+        for h in snap["histograms"]:
+            key = _key(h["name"], h["labels"])
+            hist = _histograms.setdefault(key, {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0})
+            hist["buckets"] = [a + b for a, b in zip(hist["buckets"], h["buckets"])]
+            hist["count"] += h["count"]
+            hist["sum"] += h["sum"]
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for k, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+# Prometheus text exposition format (version 0.0.4)
+def render_prometheus():
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, dict(hist, buckets=list(hist["buckets"]))) for key, hist in _histograms.items())
+
+    lines = []
+    described = set()
+
+    def describe(name, kind):
+        if name in described:
+            return
+        described.add(name)
+        declared, help_text = METRICS.get(name, (kind, None))
+        if help_text:
+            lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {declared}")
+
+    for (name, labels), value in counters:
+        describe(name, "counter")
+        lines.append(f"{name}{_labels(labels)} {value}")
+
+    for (name, labels), hist in histograms:
+        describe(name, "histogram")
+        for bound, count in zip(BUCKETS, hist["buckets"]):
+            lines.append(f"{name}_bucket{_labels(labels, [('le', str(bound))])} {count}")
+        lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {hist['count']}")
+        lines.append(f"{name}_sum{_labels(labels)} {hist['sum']}")
+        lines.append(f"{name}_count{_labels(labels)} {hist['count']}")
+
+    return "\n".join(lines) + "\n"
+
+
+# Write one JSON line describing a batch run: its name, any extra fields and
+# the current metrics snapshot. Goes to $METRICS_LOG if set, else stderr.
+def log_batch(run, **fields):
+    record = {
+        "run": run,
+        "logged_at": datetime.now(timezone.utc).isoformat(),
+        **fields,
+        "metrics": snapshot(),
+    }
+    line = json.dumps(record, default=str)
+    path = os.getenv("METRICS_LOG")
+    if path:
+        with open(path, "a") as f:
+            f.write(line + "\n")
+    else:
+        print(line, file=sys.stderr)
+    return record
+
+
+# Profile the block with cProfile when `enabled` is true and write the stats
+# to $PROFILE_DIR (default: the working directory) as <name>-<timestamp>.prof
+@contextmanager
+def profile(name, enabled=True):
+    if not enabled:
+        yield None
+        return
+
+    profiler = cProfile.Profile()
+    safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in name).strip("_")
+    path = os.path.join(
+        os.getenv("PROFILE_DIR", "."),
+        f"{safe_name}-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')}.prof",
+    )
+    profiler.enable()
+    try:
+        yield path
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print(f"Profile written to {path}", file=sys.stderr)
@@ -0,0 +1,318 @@
+# Incremental pipeline: ingest -> detect -> distance -> classify
+#
+# Every stage keeps a per ticker (and per bot for distance) watermark in the
+# pipeline_watermark table, so a run only processes bars and anomalies that
+# arrived since the previous one. Tickers are independent and run in parallel
+# on a worker pool; the stages of one ticker run in dependency order.
+#
+# Each run ends with one structured JSON log line (see metrics.log_batch)
+# holding the stage results and the metrics gathered by every worker.
+#
+#   python pipeline.py TSLA AAPL --bot TSLA:TSLA-random --workers 4
+#   python pipeline.py TSLA --stages detect,distance --dry-run
+#   python pipeline.py TSLA --profile detect
+
+import argparse
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from db import get_conn
+import metrics
+
+STAGES = ["ingest", "detect", "distance", "classify"]
+
+DEPENDS = {
+    "ingest": [],
+    "detect": ["ingest"],
+    "distance": ["detect"],
+    "classify": ["distance"],
+}
+
+DEFAULT_START = "2024-01-01T00:00:00Z"
+
+
+def get_watermark(stage, ticker, bot=""):
+    cursor = get_conn().cursor()
+    cursor.execute(
+        "SELECT watermark FROM pipeline_watermark WHERE stage = %s AND ticker = %s AND bot = %s;",
+        (stage, ticker, bot)
+    )
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+
+def set_watermark(stage, ticker, watermark, bot=""):
+    conn = get_conn()
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        INSERT INTO pipeline_watermark (stage, ticker, bot, watermark)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (stage, ticker, bot) DO UPDATE
+        SET watermark = EXCLUDED.watermark, updated_at = now();
+        """,
+        (stage, ticker, bot, watermark)
+    )
+    conn.commit()
+    cursor.close()
+
+
+# Latest trade_time in `table` for a ticker, and how many rows are newer than `since`
+def pending_rows(table, ticker, since=None):
+    query = f"SELECT max(trade_time), count(*) FROM {table} WHERE ticker = %s"
+    params = [ticker]
+    if since is not None:
+        query += " AND trade_time > %s"
+        params.append(since)
+    cursor = get_conn().cursor()
+    cursor.execute(query, params)
+    latest, count = cursor.fetchone()
+    cursor.close()
+    return latest, count
+
+
+# Each stage takes the ticker, the bot (distance only), its watermark and the
+# run options, and returns (status, new watermark or None, detail).
+
+def run_ingest(ticker, bot, watermark, options):
+    if watermark is not None:
+        start = (watermark + timedelta(seconds=1)).isoformat()
+    else:
+        start = options["start"]
+    end = options["end"] or datetime.now(timezone.utc).isoformat()
+
+    if options["dry_run"]:
+        return "dry-run", None, f"would fetch bars {start} .. {end}"
+
+    import alpaca
+
+    filename = alpaca.get_stock_data(ticker, start, end)
+    uploaded = alpaca.upload_to_db(filename, ticker)
+    latest, _ = pending_rows("stocks", ticker)
+    return "ok", latest, f"{uploaded} bars"
+
+
+def run_detect(ticker, bot, watermark, options):
+    latest, count = pending_rows("stocks", ticker, watermark)
+    if not count:
+        return "skipped", None, "no new bars"
+    if options["dry_run"]:
+        return "dry-run", None, f"{count} new bars"
+
+    import anomaly_detection
+
+    # The model is fitted on the full history, but only anomalies past the
+    # watermark, and not already stored by the stream, are written
+    points = anomaly_detection.detect_anomalies(ticker, show=False)
+    if watermark is not None:
+        points = [pt for pt in points if pt[0] > watermark]
+    points = anomaly_detection.new_clusters(points, ticker)
+    uploaded = anomaly_detection.upload_to_db(points, ticker)
+    return "ok", latest, f"{count} new bars, {uploaded} anomalies"
+
+
+def run_distance(ticker, bot, watermark, options):
+    latest, count = pending_rows("anomaly", ticker, watermark)
+    if not count:
+        return "skipped", None, "no new anomalies"
+    if options["dry_run"]:
+        return "dry-run", None, f"{count} new anomalies"
+
+    import dtw
+
+    anomaly_data = dtw.calc_anomaly_distance(ticker, bot, since=watermark, plot=False)
+    return "ok", latest, f"{len(anomaly_data)} distances"
+
+
+def run_classify(ticker, bot, watermark, options):
+    latest, count = pending_rows("anomaly", ticker, watermark)
+    if not count:
+        return "skipped", None, "no new anomalies"
+    if options["dry_run"]:
+        return "dry-run", None, f"{count} new anomalies"
+
+    import classification
+
+    classification_data, _, failed = classification.classify_anomalies(ticker, since=watermark)
+    if not failed:
+        return "ok", latest, f"{len(classification_data)} classified"
+
+    # Only move past the anomalies classified before the first failure, so
+    # the failed ones (and everything after them) are retried next run
+    first_failure = min(failed)
+    done = [entry["trade_time"] for entry in classification_data if entry["trade_time"] < first_failure]
+    return "failed", max(done) if done else None, (
+        f"{len(classification_data)} classified, {len(failed)} failed from {first_failure}"
+    )
+
+
+RUNNERS = {
+    "ingest": run_ingest,
+    "detect": run_detect,
+    "distance": run_distance,
+    "classify": run_classify,
+}
+
+
+# Build the stage graph for one ticker: a list of (stage, bot) nodes in
+# execution order and, for each node, the nodes it waits on
+def build_graph(stages, bots):
+    nodes = []
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        if stage == "distance":
+            nodes.extend(("distance", bot) for bot in bots)
+        else:
+            nodes.append((stage, ""))
+
+    def resolve(stage):
+        deps = []
+        for dep in DEPENDS[stage]:
+            matching = [node for node in nodes if node[0] == dep]
+            deps.extend(matching if matching else resolve(dep))
+        return deps
+
+    return nodes, {node: resolve(node[0]) for node in nodes}
+
+
+# Run every selected stage for one ticker; executed inside a pool worker
+def run_ticker(ticker, bots, stages, options):
+    nodes, deps = build_graph(stages, bots)
+    status = {}
+    results = []
+
+    for node in nodes:
+        stage, bot = node
+        started = time.perf_counter()
+
+        if any(status[dep] in ("failed", "blocked") for dep in deps[node]):
+            status[node] = "blocked"
+            results.append({
+                "ticker": ticker, "stage": stage, "bot": bot, "status": "blocked",
+                "seconds": 0.0, "detail": "upstream stage failed",
+            })
+            continue
+
+        try:
+            with metrics.timer("pipeline_stage_seconds", stage=stage), \
+                    metrics.profile(f"{stage}-{ticker}-{bot}", enabled=stage in options["profile"]):
+                watermark = get_watermark(stage, ticker, bot)
+                state, new_watermark, detail = RUNNERS[stage](ticker, bot, watermark, options)
+            if new_watermark is not None:
+                set_watermark(stage, ticker, new_watermark, bot)
+        except Exception as e:
+            get_conn().rollback()
+            state, detail = "failed", f"{type(e).__name__}: {e}"
+
+        status[node] = state
+        results.append({
+            "ticker": ticker, "stage": stage, "bot": bot, "status": state,
+            "seconds": time.perf_counter() - started, "detail": detail,
+        })
+
+    return results
+
+
+# Pool entry point: run one ticker and hand its metrics back to the parent
+def run_ticker_in_worker(ticker, bots, stages, options):
+    metrics.reset()
+    results = run_ticker(ticker, bots, stages, options)
+    return results, metrics.snapshot()
+
+
+def print_report(results):
+    print(f"\n{'ticker':<12} {'stage':<10} {'bot':<16} {'status':<8} {'seconds':>9}  detail")
+    for r in results:
+        print(
+            f"{r['ticker']:<12} {r['stage']:<10} {r['bot']:<16} {r['status']:<8} "
+            f"{r['seconds']:>9.3f}  {r['detail']}"
+        )
+
+    print("\nTotal time per stage:")
+    for stage in STAGES:
+        seconds = [r["seconds"] for r in results if r["stage"] == stage]
+        if seconds:
+            print(f"  {stage:<10} {sum(seconds):>9.3f}s over {len(seconds)} run(s)")
+
+
+# The anomaly table holds one bot and distance per (trade_time, ticker), so a
+# second bot for the same ticker would overwrite the first one's distances
+def parse_bots(values, tickers):
+    bots = {ticker: [] for ticker in tickers}
+    for value in values:
+        ticker, sep, bot = value.partition(":")
+        if not sep or not bot:
+            raise SystemExit(f"Invalid --bot {value!r}, expected TICKER:BOT")
+        if ticker not in bots:
+            raise SystemExit(f"--bot {value!r} refers to a ticker that is not being run")
+        if bots[ticker] and bots[ticker] != [bot]:
+            raise SystemExit(
+                f"--bot {value!r}: {ticker} is already compared against {bots[ticker][0]}; "
+                "only one bot per ticker is supported"
+            )
+        bots[ticker] = [bot]
+    return bots
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the ingest -> detect -> distance -> classify pipeline.")
+    parser.add_argument("tickers", nargs="+", help="tickers to process")
+    parser.add_argument("--bot", action="append", default=[], metavar="TICKER:BOT",
+                        help="compare TICKER against BOT in the distance stage (once per ticker)")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help=f"comma-separated subset of {','.join(STAGES)}")
+    parser.add_argument("--workers", type=int, default=1, help="number of tickers processed in parallel")
+    parser.add_argument("--start", default=DEFAULT_START, help="first bar to ingest when there is no watermark yet")
+    parser.add_argument("--end", default=None, help="last bar to ingest (default: now)")
+    parser.add_argument("--dry-run", action="store_true", help="report pending work without running any stage")
+    parser.add_argument("--profile", action="append", default=[], choices=STAGES,
+                        help="write a cProfile dump for every run of this stage (repeatable)")
+    args = parser.parse_args()
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        raise SystemExit(f"Unknown stages: {', '.join(unknown)}")
+
+    bots = parse_bots(args.bot, args.tickers)
+    options = {"dry_run": args.dry_run, "start": args.start, "end": args.end, "profile": args.profile}
+
+    started = time.perf_counter()
+    results = []
+    if args.workers > 1 and len(args.tickers) > 1:
+        # Workers open their own connection on first use (see db.get_conn)
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = [
+                pool.submit(run_ticker_in_worker, ticker, bots[ticker], stages, options)
+                for ticker in args.tickers
+            ]
+            for future in futures:
+                ticker_results, snapshot = future.result()
+                results.extend(ticker_results)
+                metrics.merge(snapshot)
+    else:
+        for ticker in args.tickers:
+            results.extend(run_ticker(ticker, bots[ticker], stages, options))
+
+    elapsed = time.perf_counter() - started
+    print_report(results)
+    print(f"\nPipeline finished in {elapsed:.3f}s")
+
+    metrics.log_batch(
+        "pipeline",
+        tickers=args.tickers,
+        stages=stages,
+        dry_run=args.dry_run,
+        seconds=elapsed,
+        results=results,
+    )
+
+    sys.exit(1 if any(r["status"] == "failed" for r in results) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# SQL and request helpers shared by the Flask app (app.py) and the async
+# ASGI app (asgi.py), so both serve the same routes with the same results.
+from datetime import datetime
+from functools import lru_cache
+
+import pandas as pd
+
+from responses import TABULAR_FORMATS
+
+STOCK_INFO_CSV = "static/stock_info.csv"
+
+STOCK_QUERY = "SELECT * FROM stocks WHERE ticker = %s ORDER BY trade_time LIMIT 1;"
+
+# Scorecard of one bot from the bot_scorecard_daily continuous aggregate:
+# one total row, one row per ticker and one row per day, in a single pass
+BOT_OVERVIEW_QUERY = """
+SELECT CASE WHEN GROUPING(ticker) = 0 THEN 'ticker'
+            WHEN GROUPING(bucket) = 0 THEN 'day'
+            ELSE 'total' END AS level,
+       ticker,
+       bucket,
+       COALESCE(sum(anomalies), 0)::bigint AS anomalies,
+       COALESCE(sum(market), 0)::bigint AS market,
+       COALESCE(sum(industry), 0)::bigint AS industry,
+       COALESCE(sum(company), 0)::bigint AS company,
+       COALESCE(sum(other), 0)::bigint AS other,
+       COALESCE(sum(unclassified), 0)::bigint AS unclassified,
+       sum(distance_sum) / NULLIF(sum(distance_count), 0) AS distance_mean,
+       approx_percentile(0.5, rollup(distance_pct)) AS distance_p50,
+       approx_percentile(0.9, rollup(distance_pct)) AS distance_p90,
+       approx_percentile(0.99, rollup(distance_pct)) AS distance_p99
+FROM bot_scorecard_daily
+WHERE bot = %s AND bucket >= time_bucket(INTERVAL '1 day', now() - %s::interval)
+GROUP BY GROUPING SETS ((), (ticker), (bucket))
+ORDER BY level, ticker, bucket;
+"""
+
+CATEGORIES = {
+    "Market": "market",
+    "Industry": "industry",
+    "Company": "company",
+    "Other": "other",
+    "Unclassified": "unclassified",
+}
+
+# Postgres interval for a time_range argument, or None if it is not supported
+def time_range_interval(time_range):
+    match time_range:
+        case "1m":
+            return "1 month"
+        case "6m":
+            return "6 months"
+        case "1y" | None | "":
+            return "1 year"
+        case _:
+            return None
+
+MAX_NEIGHBOURS = 100
+
+# (ticker, end, k, exclude, same_period) for /api/v1/similar, or an error message
+def similar_args(args):
+    ticker = args.get("ticker")
+    if not ticker:
+        return None, "No ticker specified"
+
+    end = args.get("end")
+    if end:
+        try:
+            end = datetime.fromisoformat(end.replace("Z", "+00:00"))
+        except ValueError:
+            return None, "Invalid end time"
+    else:
+        end = "infinity"
+
+    try:
+        k = int(args.get("k", 10))
+    except ValueError:
+        return None, "Invalid k"
+    if not 1 <= k <= MAX_NEIGHBOURS:
+        return None, f"k must be between 1 and {MAX_NEIGHBOURS}"
+
+    include_self = args.get("include_self", "").lower() in ("1", "true")
+    same_period = args.get("same_period", "").lower() in ("1", "true")
+    return (ticker, end, k, None if include_self else ticker, same_period), None
+
+# The CSV is static, so it is parsed once per process rather than per request
+@lru_cache(maxsize=1)
+def load_stock_info():
+    return pd.read_csv(STOCK_INFO_CSV, header=0)
+
+# Rows of the stock info CSV whose ticker matches `query`, capped at 100
+def search_stock_info(query=None):
+    stocks = load_stock_info()
+
+    if query:
+        stocks = stocks[stocks["Ticker"].str.contains(query, case=False)]
+
+    return stocks.head(100)
+
+def _scorecard_entry(row):
+    return {
+        "anomalies": row["anomalies"],
+        "categories": {name: row[column] for name, column in CATEGORIES.items()},
+        "distance": {
+            "mean": row["distance_mean"],
+            "p50": row["distance_p50"],
+            "p90": row["distance_p90"],
+            "p99": row["distance_p99"],
+        },
+    }
+
+# Response body for /api/v1/bot-overview from the BOT_OVERVIEW_QUERY rows
+def bot_scorecard(description, rows, bot, time_range):
+    scorecard = {"bot": bot, "time_range": time_range or "1y", **_scorecard_entry({
+        "anomalies": 0, **{column: 0 for column in CATEGORIES.values()},
+        "distance_mean": None, "distance_p50": None, "distance_p90": None, "distance_p99": None,
+    })}
+    tickers = []
+    daily = []
+
+    for row in rows_to_dicts(description, rows):
+        match row["level"]:
+            case "total":
+                scorecard.update(_scorecard_entry(row))
+            case "ticker":
+                tickers.append({"ticker": row["ticker"], **_scorecard_entry(row)})
+            case "day":
+                daily.append({"date": row["bucket"].date().isoformat(), **_scorecard_entry(row)})
+
+    scorecard["tickers"] = tickers
+    scorecard["daily"] = daily
+    return scorecard
+
+DAILY_COLUMNS = [
+    "date", "anomalies", *CATEGORIES.values(),
+    "distance_mean", "distance_p50", "distance_p90", "distance_p99",
+]
+
+# The per-day series of a scorecard as (rows, DAILY_COLUMNS)
+def bot_scorecard_daily(description, rows):
+    daily = [
+        (row["bucket"].date(), *(row[column] for column in DAILY_COLUMNS[1:]))
+        for row in rows_to_dicts(description, rows)
+        if row["level"] == "day"
+    ]
+    return daily, DAILY_COLUMNS
+
+# (payload, columns) for /api/v1/bot-overview: the scorecard object as JSON
+# records, or only its per-day series as a table for ?format=columns and
+# ?format=arrow, which chart clients read
+def bot_overview(description, rows, bot, time_range, fmt):
+    if fmt in TABULAR_FORMATS:
+        return bot_scorecard_daily(description, rows)
+    return bot_scorecard(description, rows, bot, time_range), None
+
+# Column names from a cursor description
+def column_names(description):
+    return [column[0] for column in description]
+
+# Turn cursor rows into dicts keyed by column name
+def rows_to_dicts(description, rows):
+    columns = column_names(description)
+    return [dict(zip(columns, row)) for row in rows]
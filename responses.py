@@ -0,0 +1,201 @@
+# Response encoding shared by app.py and asgi.py.
+#
+# Payloads are serialised straight from DataFrames, cursor rows and NumPy
+# arrays with a fast encoder (orjson when it is installed), optionally as
+# columnar JSON or Arrow IPC for chart clients, and compressed with brotli or
+# gzip when the client accepts it and the body is large enough.
+import datetime
+import decimal
+import gzip
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Bodies smaller than this are sent uncompressed
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", 1024))
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+JSON_MIMETYPE = "application/json"
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+FORMATS = ("records", "columns", "arrow")
+
+# The formats that only apply to tabular payloads
+TABULAR_FORMATS = ("columns", "arrow")
+
+
+# Raised by render() for a format that is unknown, does not apply to the
+# payload, or needs a library that is not installed
+class UnsupportedFormat(Exception):
+    pass
+
+
+# Datetimes are written as ISO 8601 with an explicit offset in every format;
+# naive values are taken as UTC, as orjson's OPT_NAIVE_UTC does
+def _isoformat(value):
+    if isinstance(value, datetime.datetime) and value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.isoformat()
+
+
+def _default(obj):
+    if isinstance(obj, np.ndarray):
+        # tolist() turns nanosecond datetimes into plain integers
+        if obj.dtype.kind == "M":
+            obj = obj.astype("datetime64[us]")
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if obj is pd.NaT or obj is pd.NA:
+        return None
+    if isinstance(obj, datetime.datetime):
+        return _isoformat(obj)
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(
+            obj,
+            default=_default,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS,
+        )
+    return json.dumps(obj, default=_default, allow_nan=False).encode()
+
+
+# A column as something orjson can write without per-value Python objects
+def _column_values(series):
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+        series = series.dt.tz_convert("UTC").dt.tz_localize(None)
+    if series.dtype.kind in "biufM" and not series.hasnans:
+        return series.to_numpy()
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def _frame(payload, columns):
+    if isinstance(payload, pd.DataFrame):
+        return payload
+    return pd.DataFrame.from_records(payload, columns=columns)
+
+
+def _encode_records(payload, columns):
+    if isinstance(payload, pd.DataFrame):
+        records = payload.astype(object).where(payload.notna(), None).to_dict(orient="records")
+        return dumps(records)
+    if columns is not None:
+        names = list(columns)
+        return dumps([dict(zip(names, row)) for row in payload])
+    return dumps(payload)
+
+
+def _encode_columns(payload, columns):
+    if isinstance(payload, pd.DataFrame):
+        data = {str(name): _column_values(payload[name]) for name in payload.columns}
+        return dumps({"columns": list(data), "data": data})
+    names = list(columns)
+    values = list(zip(*payload)) if payload else [() for _ in names]
+    return dumps({"columns": names, "data": dict(zip(names, values))})
+
+
+def _encode_arrow(payload, columns):
+    if pa is None:
+        raise UnsupportedFormat("Arrow output requires pyarrow")
+    table = pa.Table.from_pandas(_frame(payload, columns), preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+# Pick the best encoding the client accepts: brotli, then gzip, else identity
+def negotiate_encoding(accept_encoding):
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+
+    if brotli is not None and ("br" in accepted or "*" in accepted):
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body, accept_encoding):
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    encoding = negotiate_encoding(accept_encoding)
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY), encoding
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), encoding
+    return body, None
+
+
+# Encode a payload for the wire and return (body, headers).
+#
+# `payload` is a DataFrame, a list of cursor rows (with their `columns`), or
+# any other JSON-serialisable object. `fmt` is one of FORMATS; "records" (the
+# default) keeps the existing JSON shape, with tabular payloads written as a
+# list of objects keyed by column; "columns" and "arrow" only apply to
+# tabular payloads. Raises UnsupportedFormat for an unknown or unavailable
+# format; encoding errors propagate as they are.
+def render(payload, fmt=None, accept_encoding=None, columns=None):
+    fmt = fmt or "records"
+    tabular = isinstance(payload, pd.DataFrame) or columns is not None
+
+    if fmt == "records":
+        body, mimetype = _encode_records(payload, columns), JSON_MIMETYPE
+    elif fmt == "columns" and tabular:
+        body, mimetype = _encode_columns(payload, columns), JSON_MIMETYPE
+    elif fmt == "arrow" and tabular:
+        body, mimetype = _encode_arrow(payload, columns), ARROW_MIMETYPE
+    else:
+        raise UnsupportedFormat(f"Unsupported format: {fmt}")
+
+    headers = {"Content-Type": mimetype, "Vary": "Accept-Encoding"}
+    body, encoding = compress(body, accept_encoding)
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return body, headers
+
+
+# (body, status, headers) for a view to return: the payload encoded for the
+# request's ?format= and Accept-Encoding, or a 400 for an unsupported format.
+# `request` is a Flask or Quart request.
+def respond(payload, request, columns=None):
+    fmt = request.args.get("format")
+    try:
+        body, headers = render(payload, fmt, request.headers.get("Accept-Encoding"), columns)
+    except UnsupportedFormat as e:
+        return dumps({"error": str(e), "provided": fmt}), 400, {"Content-Type": JSON_MIMETYPE}
+    return body, 200, headers
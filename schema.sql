@@ -1,3 +1,6 @@
+-- Requires TimescaleDB with the timescaledb_toolkit extension available on
+-- the server (e.g. the timescale/timescaledb-ha image); db.apply_schema
+-- checks for both before running this file.
 CREATE TABLE IF NOT EXISTS stocks ( id SERIAL, trade_time TIMESTAMPTZ NOT NULL,
                                                                       close_price FLOAT NOT NULL,
                                                                                         high_price FLOAT NOT NULL,
@@ -12,7 +15,52 @@ CREATE TABLE IF NOT EXISTS stocks ( id SERIAL, trade_time TIMESTAMPTZ NOT NULL,
 
 SELECT create_hypertable('stocks', 'trade_time', if_not_exists => TRUE);
 
+-- One bar per ticker and hour, so re-ingested and re-streamed bars are
+-- skipped (ON CONFLICT) instead of duplicated. Databases created before the
+-- index can hold duplicates, which would make creating it fail: the first
+-- bar ingested is kept. The DELETE only runs while the index does not exist.
+DELETE FROM stocks AS a USING stocks AS b
+WHERE to_regclass('stocks_ticker_trade_time_key') IS NULL
+  AND a.ticker = b.ticker AND a.trade_time = b.trade_time AND a.id > b.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS stocks_ticker_trade_time_key ON stocks (ticker, trade_time);
+
 CREATE TABLE IF NOT EXISTS anomaly (trade_time TIMESTAMPTZ NOT NULL, ticker TEXT NOT NULL, bot TEXT, distance FLOAT, classification TEXT, descr TEXT, 
 PRIMARY KEY (trade_time, ticker));
 
-SELECT create_hypertable('anomaly', 'trade_time', if_not_exists => TRUE);
\ No newline at end of file
+SELECT create_hypertable('anomaly', 'trade_time', if_not_exists => TRUE);
+
+CREATE TABLE IF NOT EXISTS pipeline_watermark (stage TEXT NOT NULL, ticker TEXT NOT NULL, bot TEXT NOT NULL DEFAULT '', watermark TIMESTAMPTZ NOT NULL, updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+PRIMARY KEY (stage, ticker, bot));
+
+-- Per-bot scorecards for /api/v1/bot-overview, maintained incrementally as a
+-- continuous aggregate over the anomaly hypertable. Distance percentiles use
+-- the toolkit's percentile_agg so daily buckets can be rolled up to any range.
+CREATE EXTENSION IF NOT EXISTS timescaledb_toolkit;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS bot_scorecard_daily
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT time_bucket(INTERVAL '1 day', trade_time) AS bucket,
+       bot,
+       ticker,
+       count(*) AS anomalies,
+       count(*) FILTER (WHERE classification = 'Market') AS market,
+       count(*) FILTER (WHERE classification = 'Industry') AS industry,
+       count(*) FILTER (WHERE classification = 'Company') AS company,
+       count(*) FILTER (WHERE classification NOT IN ('Market', 'Industry', 'Company')) AS other,
+       count(*) FILTER (WHERE classification IS NULL) AS unclassified,
+       count(distance) AS distance_count,
+       sum(distance) AS distance_sum,
+       percentile_agg(distance) AS distance_pct
+FROM anomaly
+WHERE bot IS NOT NULL
+GROUP BY bucket, bot, ticker
+WITH NO DATA;
+
+-- Re-materialise the last 400 days so late distance/classification updates
+-- are picked up for every supported range (up to 1y)
+SELECT add_continuous_aggregate_policy('bot_scorecard_daily',
+       start_offset => INTERVAL '400 days',
+       end_offset => INTERVAL '1 hour',
+       schedule_interval => INTERVAL '30 minutes',
+       if_not_exists => TRUE);
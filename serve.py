@@ -0,0 +1,67 @@
+# Production launcher for the async API (asgi.py).
+#
+#   python serve.py                      # 0.0.0.0:8080, one worker per CPU
+#   python serve.py --workers 4 --limit-concurrency 200
+#
+# Settings (flags override the environment):
+#   HOST, PORT          bind address, default 0.0.0.0:8080
+#   WEB_CONCURRENCY     worker processes; each runs its own event loop and
+#                       connection pool. Default: number of CPUs.
+#   LIMIT_CONCURRENCY   max in-flight requests per worker before answering
+#                       503, default 256. Keep it well above the dashboard's
+#                       fan-out so parallel requests are never rejected.
+#   DB_POOL_MIN/MAX     async Postgres pool size per worker, default 1/10.
+#                       WEB_CONCURRENCY * DB_POOL_MAX must stay below the
+#                       server's max_connections.
+#   KEEPALIVE           idle keep-alive timeout in seconds, default 5.
+#
+# /metrics reports the metrics of the worker that answers the scrape, so
+# with several workers, scrape them individually (one port each) or run
+# with --workers 1 behind a process manager.
+#
+# schema.sql is applied once here, before the workers are spawned. Pass
+# --skip-schema when migrations are run as a separate deployment step. The
+# database needs TimescaleDB with the timescaledb_toolkit extension (for the
+# bot scorecards); startup fails with an explicit error without it.
+#
+# For development the synchronous Flask app is still available with
+# `python app.py`.
+import argparse
+import os
+
+import psycopg2
+import uvicorn
+
+from db import app_config, apply_schema
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the async API with uvicorn.")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", 8080)))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--limit-concurrency", type=int, default=int(os.getenv("LIMIT_CONCURRENCY", 256)))
+    parser.add_argument("--keepalive", type=int, default=int(os.getenv("KEEPALIVE", 5)))
+    parser.add_argument("--skip-schema", action="store_true", help="do not apply schema.sql before starting")
+    args = parser.parse_args()
+
+    if not args.skip_schema:
+        conn = psycopg2.connect(**app_config())
+        try:
+            apply_schema(conn)
+        finally:
+            conn.close()
+
+    uvicorn.run(
+        "asgi:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        limit_concurrency=args.limit_concurrency,
+        timeout_keep_alive=args.keepalive,
+        proxy_headers=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+# Windowed similarity search over bar series.
+#
+# Every ticker (or bot) series is cut into overlapping windows of WINDOW bars.
+# Each window is turned into the same feature vectors dtw.bar_to_vector
+# builds, z-normalised per feature, and reduced to a compact PAA embedding
+# (SEGMENTS means per feature). A BallTree over the embeddings returns
+# candidate neighbours without scanning every window, and the candidates are
+# re-ranked with exact DTW on the z-normalised windows.
+#
+# A search returns the best window of each ticker, so one series cannot fill
+# the results with overlapping windows. With same_period only windows that
+# overlap the query's time span compete ("who behaved like TSLA last week").
+#
+# The index is updated incrementally: add_rows() takes the bars that arrived
+# since the last call and only cuts the new windows. refresh() loads, per
+# ticker, every bar newer than the last one indexed for that ticker, so new
+# tickers and tickers that lag behind others are picked up. Bars backfilled
+# before a ticker's last indexed bar are only picked up when the process (and
+# with it the index) restarts.
+#
+# Bars are ingested by other processes (pipeline.py workers, stream.py,
+# alpaca.py), so the API cannot feed them to its index in-process. Instead
+# it polls: a query refreshes the index when it is REFRESH_SECONDS old.
+import threading
+import time
+from bisect import bisect_left
+
+import numpy as np
+
+from dtw import bar_to_vector
+import metrics
+
+WINDOW = 24
+STRIDE = 6
+SEGMENTS = 6
+
+# Tickers taken from the tree per requested neighbour before DTW re-ranking
+CANDIDATE_FACTOR = 4
+
+# Windows per candidate ticker re-ranked with DTW; only the best one is returned
+WINDOWS_PER_TICKER = 3
+
+# Rebuild the tree once this share of the windows is only in the linear-scan buffer
+REBUILD_RATIO = 0.1
+REBUILD_MIN = 256
+
+# Seconds between index refreshes from the database
+REFRESH_SECONDS = 30
+
+BAR_COLUMNS = "trade_time, open_price, high_price, low_price, close_price, volume, num_trades, vwap"
+
+# Bars newer than each ticker's watermark, every bar of tickers without one;
+# the parameters are the indexed tickers and their watermarks (see
+# SimilarityIndex.refresh_params). The tickers are listed with a skip scan
+# and each one's new bars read by a range scan, both over the
+# (ticker, trade_time) index, so a refresh does not read the whole table.
+BARS_SINCE_QUERY = f"""
+WITH RECURSIVE tickers AS (
+    (SELECT ticker FROM stocks ORDER BY ticker LIMIT 1)
+    UNION ALL
+    SELECT (SELECT s.ticker FROM stocks AS s WHERE s.ticker > t.ticker ORDER BY s.ticker LIMIT 1)
+    FROM tickers AS t WHERE t.ticker IS NOT NULL
+)
+SELECT t.ticker, b.* FROM tickers AS t
+LEFT JOIN unnest(%s::text[], %s::timestamptz[]) AS w(ticker, watermark) ON w.ticker = t.ticker
+CROSS JOIN LATERAL (
+    SELECT {BAR_COLUMNS} FROM stocks AS s
+    WHERE s.ticker = t.ticker AND s.trade_time > COALESCE(w.watermark, '-infinity')
+) AS b
+WHERE t.ticker IS NOT NULL
+ORDER BY t.ticker, b.trade_time;
+"""
+
+QUERY_WINDOW_QUERY = f"""
+SELECT * FROM (
+    SELECT {BAR_COLUMNS} FROM stocks
+    WHERE ticker = %s AND trade_time <= %s
+    ORDER BY trade_time DESC
+    LIMIT {WINDOW}
+) AS latest ORDER BY trade_time;
+"""
+
+
+# (trade_time, open, high, low, close, volume, num_trades, vwap) rows as a
+# (len(rows), 7) feature matrix
+def rows_to_matrix(rows):
+    return np.array([
+        bar_to_vector({"o": o, "h": h, "l": l, "c": c, "v": v, "n": n, "vw": vw})
+        for _, o, h, l, c, v, n, vw in rows
+    ], dtype=float).reshape(len(rows), -1)
+
+
+def znormalise(window):
+    std = window.std(axis=0)
+    std[std < 1e-12] = 1.0
+    return (window - window.mean(axis=0)) / std
+
+
+# Piecewise aggregate approximation of a z-normalised window, flattened
+def embed(znormed):
+    segments = np.array_split(znormed, SEGMENTS, axis=0)
+    return np.concatenate([segment.mean(axis=0) for segment in segments])
+
+
+def dtw_distance(a, b):
+    from fastdtw import dtw
+
+    distance, _ = dtw(a, b, dist=lambda x, y: float(np.linalg.norm(x - y)))
+    return distance
+
+
+class SimilarityIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = []        # (ticker, start_time, end_time) per window
+        self.windows = []        # z-normalised (WINDOW, features) arrays
+        self.embeddings = []     # PAA embedding per window
+        self.by_ticker = {}      # ticker -> indices of its windows, oldest first
+        self.ends = {}           # ticker -> end times of those windows
+        self.tails = {}          # ticker -> (times, matrix) not yet cut into windows
+        self.watermarks = {}     # ticker -> last bar time seen
+        self.refreshed_at = 0.0
+        self.tree = None
+        self.tree_size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Append bars for `ticker` (oldest first) and index every completed window
+    def add_rows(self, ticker, rows):
+        with self.lock:
+            last = self.watermarks.get(ticker)
+            if last is not None:
+                rows = [row for row in rows if row[0] > last]
+            if not rows:
+                return 0
+
+            times, matrix = self.tails.get(ticker, ([], np.empty((0, 7))))
+            times = times + [row[0] for row in rows]
+            matrix = np.vstack([matrix, rows_to_matrix(rows)])
+
+            added = 0
+            start = 0
+            while start + WINDOW <= len(times):
+                window = znormalise(matrix[start:start + WINDOW])
+                self.entries.append((ticker, times[start], times[start + WINDOW - 1]))
+                self.by_ticker.setdefault(ticker, []).append(len(self.entries) - 1)
+                self.ends.setdefault(ticker, []).append(times[start + WINDOW - 1])
+                self.windows.append(window.astype(np.float32))
+                self.embeddings.append(embed(window))
+                added += 1
+                start += STRIDE
+
+            self.tails[ticker] = (times[start:], matrix[start:])
+            self.watermarks[ticker] = times[-1]
+
+            pending = len(self.entries) - self.tree_size
+            if pending >= max(REBUILD_MIN, REBUILD_RATIO * self.tree_size):
+                self._rebuild()
+            return added
+
+    def _rebuild(self):
+        from sklearn.neighbors import BallTree
+
+        self.tree = BallTree(np.array(self.embeddings))
+        self.tree_size = len(self.embeddings)
+
+    # Indices and embedding distances of the `count` nearest windows: a tree
+    # query over the indexed part plus a linear scan of the unindexed tail
+    def _candidates(self, embedding, count):
+        found = []
+        if self.tree is not None and self.tree_size:
+            distances, indices = self.tree.query([embedding], k=min(count, self.tree_size))
+            found.extend(zip(distances[0], indices[0]))
+        if len(self.embeddings) > self.tree_size:
+            tail = np.array(self.embeddings[self.tree_size:])
+            distances = np.linalg.norm(tail - embedding, axis=1)
+            found.extend((d, self.tree_size + i) for i, d in enumerate(distances))
+        found.sort()
+        return found[:count]
+
+    # Candidates from `want` distinct tickers other than `exclude` (or from
+    # every ticker there is), nearest first
+    def _nearest(self, embedding, want, exclude):
+        want = min(want, len(self.by_ticker) - (exclude in self.by_ticker))
+        if want <= 0:
+            return []
+        count = want * WINDOWS_PER_TICKER
+        while True:
+            candidates = self._candidates(embedding, count)
+            kept = [(d, i) for d, i in candidates if self.entries[i][0] != exclude]
+            if len({self.entries[i][0] for _, i in kept}) >= want or len(candidates) >= len(self.entries):
+                return kept
+            count *= 2  # the nearest windows came from too few tickers
+
+    # Windows of every ticker other than `exclude` that overlap [start, end],
+    # nearest first
+    def _overlapping(self, embedding, start, end, exclude):
+        indices = []
+        for ticker, windows in self.by_ticker.items():
+            if ticker == exclude:
+                continue
+            for i in windows[bisect_left(self.ends[ticker], start):]:
+                if self.entries[i][1] > end:
+                    break
+                indices.append(i)
+        if not indices:
+            return []
+        distances = np.linalg.norm(np.array([self.embeddings[i] for i in indices]) - embedding, axis=1)
+        return sorted(zip(distances, indices))
+
+    # Up to WINDOWS_PER_TICKER candidates of each of the first `tickers` tickers
+    def _per_ticker(self, candidates, tickers):
+        counts = {}
+        kept = []
+        for d, i in candidates:
+            ticker = self.entries[i][0]
+            if ticker not in counts:
+                if len(counts) == tickers:
+                    continue
+                counts[ticker] = 0
+            if counts[ticker] < WINDOWS_PER_TICKER:
+                counts[ticker] += 1
+                kept.append((d, i))
+        return kept
+
+    # The k tickers most similar to `rows` (a WINDOW-bar query series), each
+    # with its best window, re-ranked by exact DTW. With same_period only
+    # windows overlapping the query's time span are considered.
+    def search(self, rows, k=10, exclude=None, same_period=False):
+        if len(rows) < WINDOW:
+            raise ValueError(f"Need {WINDOW} bars to search, got {len(rows)}")
+
+        rows = rows[-WINDOW:]
+        query = znormalise(rows_to_matrix(rows))
+        embedding = embed(query)
+        want = k * CANDIDATE_FACTOR
+
+        # Only picking the candidates needs the lock; windows are never
+        # modified once indexed, so DTW can run on them while bars are added
+        with self.lock:
+            if same_period:
+                candidates = self._overlapping(embedding, rows[0][0], rows[-1][0], exclude)
+            else:
+                candidates = self._nearest(embedding, want, exclude)
+            kept = [(d, self.entries[i], self.windows[i]) for d, i in self._per_ticker(candidates, want)]
+
+        with metrics.timer("dtw_seconds", kind="similarity"):
+            ranked = sorted(
+                ((dtw_distance(query, window), d, entry) for d, entry, window in kept),
+                key=lambda candidate: candidate[:2],
+            )
+
+        results = []
+        seen = set()
+        for distance, d, (ticker, start, end) in ranked:
+            if ticker in seen:
+                continue
+            seen.add(ticker)
+            results.append({
+                "ticker": ticker,
+                "start": start,
+                "end": end,
+                "distance": distance,
+                "embedding_distance": float(d),
+            })
+            if len(results) == k:
+                break
+        return results
+
+    def needs_refresh(self):
+        return time.monotonic() - self.refreshed_at >= REFRESH_SECONDS
+
+    # Feed the rows of BARS_SINCE_QUERY (ticker first) into the index
+    def add_query_rows(self, rows):
+        added = 0
+        start = 0
+        for i in range(1, len(rows) + 1):
+            if i == len(rows) or rows[i][0] != rows[start][0]:
+                added += self.add_rows(rows[start][0], [row[1:] for row in rows[start:i]])
+                start = i
+        self.refreshed_at = time.monotonic()
+        return added
+
+    # Parameters of BARS_SINCE_QUERY: the indexed tickers and their watermarks
+    def refresh_params(self):
+        with self.lock:
+            tickers = list(self.watermarks)
+            return tickers, [self.watermarks[ticker] for ticker in tickers]
+
+    def refresh(self, conn):
+        cursor = conn.cursor()
+        cursor.execute(BARS_SINCE_QUERY, self.refresh_params())
+        rows = cursor.fetchall()
+        cursor.close()
+        return self.add_query_rows(rows)
+
+
+# Shared per-process index used by the API
+_index = None
+
+def get_index():
+    global _index
+    if _index is None:
+        _index = SimilarityIndex()
+    return _index
+
+# Drop the shared index so the next get_index() rebuilds it from scratch
+def reset_index():
+    global _index
+    _index = None
@@ -0,0 +1,479 @@
+# Live bar ingestion with online anomaly scoring.
+#
+# Consumes minute bars from Alpaca's market data websocket (or replays a
+# recorded session from a JSON-lines file) and rolls them up into hourly bars,
+# the timeframe of the stocks table and the batch stages. Each ticker keeps a
+# fixed-size ring buffer of recent hourly bars, computes the
+# price_change/percentage_change features online and scores every hourly bar
+# with an IsolationForest refitted on the buffer. Bars and anomalies are
+# written in micro-batches, so anomalies reach the database seconds after the
+# hour closes instead of after the next batch run.
+#
+# An hour is closed, scored and written once a bar from a later hour arrives
+# or, failing that, CLOSE_GRACE_SECONDS after it ended, so the last hour of
+# the session does not wait for the next one. Only hours that are incomplete
+# are dropped and left to the batch ingest: the one in progress when the
+# stream starts or reconnects, and one that has not ended when it stops.
+#
+#   python stream.py TSLA AAPL                          # live, IEX feed
+#   python stream.py TSLA --record session.jsonl        # live, and record frames
+#   python stream.py TSLA --replay session.jsonl --speed 60
+#
+# A recording holds one websocket frame (a JSON array of messages) per line.
+# A reconnect is recorded as a [{"T": "gap"}] frame.
+
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from alpaca import API_KEY, API_SECRET, INSERT_BARS_SQL, bar_to_row
+from anomaly_detection import CLUSTER_HOURS, FEATURES, INSERT_ANOMALIES_SQL, ISOLATION_FOREST_PARAMS
+from db import close_conn, get_conn
+import metrics
+
+STREAM_URL = "wss://stream.data.alpaca.markets/v2/{feed}"
+
+BUFFER_SIZE = 500
+MIN_FIT = 100
+REFIT_EVERY = 50
+BATCH_SIZE = 200
+FLUSH_SECONDS = 2.0
+# Time after the end of an hour for its last minute bars to arrive
+CLOSE_GRACE_SECONDS = 60
+RECONNECT_MAX_SECONDS = 60
+
+# OnlineScorer.update results
+STALE = "stale"        # duplicate or out of order, not to be written
+ACCEPTED = "accepted"
+ANOMALY = "anomaly"
+
+# Frame alpaca_frames yields (and records) after the connection dropped
+GAP_FRAME = [{"T": "gap"}]
+
+# Last BUFFER_SIZE bars of a ticker, oldest first, to warm up the ring buffer
+SEED_QUERY = """
+SELECT * FROM (
+    SELECT trade_time, open_price, high_price, low_price, close_price, volume, num_trades, vwap
+    FROM stocks WHERE ticker = %s
+    ORDER BY trade_time DESC
+    LIMIT %s
+) AS latest ORDER BY trade_time;
+"""
+
+
+# Latest stored anomaly of a ticker, so the stream does not store another one
+# for a cluster the batch detector already stored
+LAST_ANOMALY_QUERY = "SELECT max(trade_time) FROM anomaly WHERE ticker = %s;"
+
+
+def parse_time(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+# Rolls minute bars up into hourly bars like Alpaca's 1Hour bars: stamped
+# with the start of the hour, open of the first minute, close of the last,
+# summed volume and trades, volume-weighted vwap. The stream sends every
+# ticker's bar for a minute together, so an hour is complete once a bar from
+# a later hour arrives for any ticker, or once the clock has passed its end.
+# An hour already under way when the stream started is incomplete and
+# dropped.
+class HourlyRollup:
+    def __init__(self):
+        self.closed = {}       # ticker -> start of the last hour closed
+        self.reset()
+
+    # Forget open hours and start over, e.g. after bars were missed
+    def reset(self):
+        self.open = {}         # ticker -> hourly bar being built
+        self.last = {}         # ticker -> time of the last minute bar taken
+        self.since = None      # time of the first minute bar seen
+
+    # Add a minute bar; False if it is a duplicate or older than the
+    # ticker's previous bar (e.g. resent after a reconnect)
+    def add(self, bar, ticker):
+        t = parse_time(bar["t"])
+        last = self.last.get(ticker)
+        if last is not None and t <= last:
+            return False
+        hour = t.replace(minute=0, second=0, microsecond=0)
+        closed = self.closed.get(ticker)
+        if closed is not None and hour <= closed:
+            return False  # arrived after its hour was closed
+        self.last[ticker] = t
+        if self.since is None:
+            self.since = t
+
+        hourly = self.open.get(ticker)
+        if hourly is None:
+            self.open[ticker] = {
+                "t": hour,
+                "o": bar["o"], "h": bar["h"], "l": bar["l"], "c": bar["c"],
+                "v": bar["v"], "n": bar["n"], "vw": bar["vw"], "pv": bar["vw"] * bar["v"],
+            }
+        else:
+            hourly["h"] = max(hourly["h"], bar["h"])
+            hourly["l"] = min(hourly["l"], bar["l"])
+            hourly["c"] = bar["c"]
+            hourly["v"] += bar["v"]
+            hourly["n"] += bar["n"]
+            hourly["pv"] += bar["vw"] * bar["v"]
+            hourly["vw"] = hourly["pv"] / hourly["v"] if hourly["v"] else bar["vw"]
+        return True
+
+    # Remove the open hours that ended at or before `t` and return the
+    # complete ones as (ticker, hourly bar) pairs
+    def close_ended(self, t):
+        t = parse_time(t)
+        closed = []
+        for ticker, hourly in list(self.open.items()):
+            if hourly["t"] + timedelta(hours=1) <= t:
+                del self.open[ticker]
+                self.closed[ticker] = hourly["t"]
+                if hourly["t"] >= self.since:
+                    closed.append((ticker, {k: v for k, v in hourly.items() if k != "pv"}))
+        return closed
+
+
+# Stream time of a replay: the time of the latest replayed bar, advanced by
+# the wall time since then at the replay speed (not at all with speed 0)
+class ReplayClock:
+    def __init__(self, speed=0.0):
+        self.speed = speed
+        self.bar_time = datetime.min.replace(tzinfo=timezone.utc)
+        self.advanced_at = time.monotonic()
+
+    def advance(self, t):
+        self.bar_time = max(self.bar_time, parse_time(t))
+        self.advanced_at = time.monotonic()
+
+    def __call__(self):
+        return self.bar_time + timedelta(seconds=(time.monotonic() - self.advanced_at) * self.speed)
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+# Ring buffer of feature rows for one ticker, with a model refitted on it
+class OnlineScorer:
+    def __init__(self, ticker, buffer_size=BUFFER_SIZE, min_fit=MIN_FIT, refit_every=REFIT_EVERY):
+        self.ticker = ticker
+        self.buffer = deque(maxlen=buffer_size)
+        self.min_fit = min_fit
+        self.refit_every = refit_every
+        self.model = None
+        self.since_fit = 0
+        self.prev_close = None
+        self.last_time = None
+        self.last_anomaly = None
+
+    # FEATURES for a bar, computed from the previous close
+    def features(self, bar):
+        close = bar["c"]
+        if self.prev_close is None:
+            price_change = percentage_change = None
+        else:
+            price_change = close - self.prev_close
+            percentage_change = price_change / self.prev_close if self.prev_close else None
+        values = {
+            "o": bar["o"], "h": bar["h"], "l": bar["l"], "c": close,
+            "v": bar["v"], "vw": bar["vw"],
+            "price_change": price_change, "percentage_change": percentage_change,
+        }
+        return [values[name] for name in FEATURES]
+
+    def fit(self):
+        from sklearn.ensemble import IsolationForest
+
+        model = IsolationForest(**ISOLATION_FOREST_PARAMS)
+        with metrics.timer("isolation_forest_fit_seconds", mode="stream"):
+            model.fit(list(self.buffer))
+        self.model = model
+        self.since_fit = 0
+
+    # Add a bar to the buffer without scoring it (used to warm up)
+    def seed(self, bar):
+        row = self.features(bar)
+        self.prev_close = bar["c"]
+        self.last_time = parse_time(bar["t"])
+        if None not in row:
+            self.buffer.append(row)
+
+    # Add a bar and return STALE if it is not newer than the last bar (it is
+    # then ignored), ANOMALY if it is anomalous, else ACCEPTED. Bars within
+    # CLUSTER_HOURS of the previous anomaly are folded into it, like the
+    # batch detector does.
+    def update(self, bar):
+        t = parse_time(bar["t"])
+        if self.last_time is not None and t <= self.last_time:
+            return STALE
+
+        row = self.features(bar)
+        self.prev_close = bar["c"]
+        self.last_time = t
+        if None in row:
+            return ACCEPTED
+
+        if self.model is None or self.since_fit >= self.refit_every:
+            if len(self.buffer) >= self.min_fit:
+                self.fit()
+
+        anomalous = False
+        if self.model is not None:
+            with metrics.timer("stream_score_seconds"):
+                anomalous = self.model.predict([row])[0] == -1
+
+        self.buffer.append(row)
+        self.since_fit += 1
+
+        if not anomalous:
+            return ACCEPTED
+        if self.last_anomaly is not None and t - self.last_anomaly <= timedelta(hours=CLUSTER_HOURS):
+            return ACCEPTED
+        self.last_anomaly = t
+        return ANOMALY
+
+
+# Collects bar and anomaly rows and writes them in one transaction per batch
+class MicroBatcher:
+    def __init__(self, batch_size=BATCH_SIZE, flush_seconds=FLUSH_SECONDS, dry_run=False):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.dry_run = dry_run
+        self.bars = []
+        self.anomalies = []
+        self.flushed_at = time.monotonic()
+
+    def add_bar(self, bar, ticker):
+        self.bars.append(bar_to_row(bar, ticker))
+
+    def add_anomaly(self, bar, ticker):
+        self.anomalies.append((bar["t"], ticker))
+
+    def due(self):
+        pending = len(self.bars) + len(self.anomalies)
+        return pending >= self.batch_size or (
+            pending and time.monotonic() - self.flushed_at >= self.flush_seconds
+        )
+
+    def flush(self):
+        bars, anomalies = self.bars, self.anomalies
+        self.bars, self.anomalies = [], []
+        self.flushed_at = time.monotonic()
+        if self.dry_run or not (bars or anomalies):
+            return len(bars), len(anomalies)
+
+        try:
+            with metrics.timer("stream_flush_seconds"):
+                self.write(bars, anomalies)
+        except Exception as e:
+            # Keep the rows for the next flush rather than dropping them
+            self.bars[:0], self.anomalies[:0] = bars, anomalies
+            print(f"Flush failed, will retry: {e}")
+            return 0, 0
+        return len(bars), len(anomalies)
+
+    # Write one batch in a single transaction. When the rollback fails too the
+    # connection is broken, so it is dropped and the next flush reconnects.
+    def write(self, bars, anomalies):
+        conn = get_conn()
+        try:
+            with conn.cursor() as cursor:
+                if bars:
+                    execute_values(cursor, INSERT_BARS_SQL, bars)
+                if anomalies:
+                    execute_values(cursor, INSERT_ANOMALIES_SQL, anomalies)
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close_conn()
+            raise
+
+
+# Frames from Alpaca's websocket, reconnecting with backoff when it drops
+async def alpaca_frames(tickers, feed, record=None):
+    import websockets
+
+    backoff = 1
+    while True:
+        try:
+            async with websockets.connect(STREAM_URL.format(feed=feed)) as ws:
+                await ws.recv()  # [{"T": "success", "msg": "connected"}]
+                await ws.send(json.dumps({"action": "auth", "key": API_KEY, "secret": API_SECRET}))
+                reply = json.loads(await ws.recv())
+                if not any(m.get("T") == "success" and m.get("msg") == "authenticated" for m in reply):
+                    raise RuntimeError(f"Alpaca stream authentication failed: {reply}")
+                await ws.send(json.dumps({"action": "subscribe", "bars": list(tickers)}))
+                backoff = 1
+
+                async for raw in ws:
+                    if record is not None:
+                        record.write(raw if isinstance(raw, str) else raw.decode())
+                        record.write("\n")
+                        record.flush()
+                    yield json.loads(raw)
+        except (OSError, websockets.ConnectionClosed) as e:
+            print(f"Stream disconnected ({e}), reconnecting in {backoff}s")
+            if record is not None:
+                record.write(json.dumps(GAP_FRAME) + "\n")
+                record.flush()
+            yield GAP_FRAME
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, RECONNECT_MAX_SECONDS)
+
+
+# Frames from a recording; with speed > 0 the gaps between bars are replayed
+# `speed` times faster than real time, with speed 0 as fast as possible.
+# `clock` (a ReplayClock) is advanced to the bars replayed.
+async def replay_frames(path, speed=0.0, clock=None):
+    previous = None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            frame = json.loads(line)
+            times = [parse_time(m["t"]) for m in frame if m.get("T") == "b"]
+            if speed > 0:
+                if times and previous is not None:
+                    await asyncio.sleep(max(0.0, (times[0] - previous).total_seconds() / speed))
+                if times:
+                    previous = times[-1]
+            if clock is not None and times:
+                clock.advance(max(times))
+            yield frame
+
+
+def seed_scorers(scorers):
+    cursor = get_conn().cursor()
+    for ticker, scorer in scorers.items():
+        cursor.execute(SEED_QUERY, (ticker, scorer.buffer.maxlen))
+        for t, o, h, l, c, v, n, vw in cursor.fetchall():
+            scorer.seed({"t": t, "o": o, "h": h, "l": l, "c": c, "v": v, "n": n, "vw": vw})
+        if len(scorer.buffer) >= scorer.min_fit:
+            scorer.fit()
+        cursor.execute(LAST_ANOMALY_QUERY, (ticker,))
+        scorer.last_anomaly = cursor.fetchone()[0]
+        print(f"Seeded {ticker} with {len(scorer.buffer)} bars")
+    cursor.close()
+
+
+# Consume `frames` until they end. `clock` returns the stream's current time:
+# the wall clock when live, a ReplayClock for replays.
+async def run(frames, scorers, batcher, clock=utcnow):
+    lock = asyncio.Lock()
+    rollup = HourlyRollup()
+
+    # One flush at a time: both the frame loop and the timer can trigger it
+    async def flush():
+        async with lock:
+            bars, anomalies = await asyncio.to_thread(batcher.flush)
+        if bars or anomalies:
+            metrics.log_batch("stream", bars=bars, anomalies=anomalies)
+
+    # Close the hours that ended a grace period ago but were not closed by a
+    # later bar, e.g. the last hour before the market closes
+    def close_ended():
+        for ticker, bar in rollup.close_ended(clock() - timedelta(seconds=CLOSE_GRACE_SECONDS)):
+            handle(ticker, bar)
+
+    async def flush_periodically():
+        while True:
+            await asyncio.sleep(batcher.flush_seconds)
+            close_ended()
+            if batcher.due():
+                await flush()
+
+    # Score a complete hourly bar and queue it (and its anomaly) for writing
+    def handle(ticker, bar):
+        status = scorers[ticker].update(bar)
+        if status == STALE:
+            metrics.inc("stream_stale_bars_total", ticker=ticker, timeframe="hour")
+            return
+        batcher.add_bar(bar, ticker)
+        if status == ANOMALY:
+            metrics.inc("stream_anomalies_total", ticker=ticker)
+            batcher.add_anomaly(bar, ticker)
+            closed_at = bar["t"] + timedelta(hours=1)
+            metrics.observe("stream_detection_lag_seconds", (datetime.now(timezone.utc) - closed_at).total_seconds())
+            print(f"Anomaly: {ticker} @ {bar['t'].isoformat()} close={bar['c']}")
+
+    flusher = asyncio.create_task(flush_periodically())
+    try:
+        async for frame in frames:
+            for message in frame:
+                if message.get("T") == "error":
+                    print(f"Stream error: {message}")
+                if message.get("T") == "gap":
+                    rollup.reset()  # the open hours are missing bars
+                if message.get("T") != "b" or message.get("S") not in scorers:
+                    continue
+
+                ticker = message["S"]
+                metrics.inc("stream_bars_total", ticker=ticker)
+                for closed_ticker, bar in rollup.close_ended(message["t"]):
+                    handle(closed_ticker, bar)
+                if not rollup.add(message, ticker):
+                    metrics.inc("stream_stale_bars_total", ticker=ticker, timeframe="minute")
+
+            if batcher.due():
+                await flush()
+    finally:
+        flusher.cancel()
+        close_ended()
+        await flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream bars and score anomalies online.")
+    parser.add_argument("tickers", nargs="+")
+    parser.add_argument("--feed", default="iex", help="Alpaca data feed (iex or sip)")
+    parser.add_argument("--replay", help="replay frames from this JSON-lines recording instead of connecting")
+    parser.add_argument("--speed", type=float, default=0.0, help="replay speed-up factor (0: as fast as possible)")
+    parser.add_argument("--record", help="append the raw websocket frames to this file")
+    parser.add_argument("--buffer", type=int, default=BUFFER_SIZE, help="bars kept per ticker")
+    parser.add_argument("--min-fit", type=int, default=MIN_FIT, help="bars needed before scoring starts")
+    parser.add_argument("--refit-every", type=int, default=REFIT_EVERY, help="refit the model after this many bars")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--flush-seconds", type=float, default=FLUSH_SECONDS)
+    parser.add_argument("--no-seed", action="store_true", help="start with empty buffers instead of recent bars")
+    parser.add_argument("--dry-run", action="store_true", help="score bars without writing to the database")
+    args = parser.parse_args()
+
+    scorers = {
+        ticker: OnlineScorer(ticker, args.buffer, args.min_fit, args.refit_every)
+        for ticker in args.tickers
+    }
+    if not args.no_seed:
+        seed_scorers(scorers)
+
+    batcher = MicroBatcher(args.batch_size, args.flush_seconds, args.dry_run)
+
+    record = open(args.record, "a") if args.record else None
+    try:
+        if args.replay:
+            clock = ReplayClock(args.speed)
+            frames = replay_frames(args.replay, args.speed, clock)
+        else:
+            clock = utcnow
+            frames = alpaca_frames(args.tickers, args.feed, record)
+        asyncio.run(run(frames, scorers, batcher, clock))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if record is not None:
+            record.close()
+
+
+if __name__ == "__main__":
+    main()
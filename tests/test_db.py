@@ -0,0 +1,157 @@
+# bulk_update (db.py): COPY escaping, argument validation and, against a
+# real database, the rows it writes and the count it returns.
+#
+# The database tests need TEST_DSN (any scratch Postgres); they work in a
+# schema of their own that is dropped afterwards.
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+TEST_DSN = os.getenv("TEST_DSN")
+
+
+def test_copy_value_escapes_copy_text_format():
+    assert db._copy_value(None) == "\\N"
+    assert db._copy_value("a\tb\nc\rd") == "a\\tb\\nc\\rd"
+    assert db._copy_value("C:\\path") == "C:\\\\path"
+    assert db._copy_value("\\N") == "\\\\N"
+    assert db._copy_value(1.5) == "1.5"
+
+
+# Just enough of a connection for the checks bulk_update makes before it
+# writes anything
+class ColumnsConnection:
+    dsn = "columns-only"
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchall(self):
+        return [(c,) for c in self.columns]
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def columns_conn():
+    db._table_columns.clear()
+    yield ColumnsConnection(["trade_time", "ticker", "bot", "distance"])
+    db._table_columns.clear()
+
+
+def test_unknown_column_is_rejected(columns_conn):
+    with pytest.raises(ValueError, match="Unknown columns for table anomaly: dist"):
+        db.bulk_update(columns_conn, "anomaly", ("trade_time", "ticker", "dist"), [])
+
+
+def test_key_must_be_part_of_columns(columns_conn):
+    with pytest.raises(ValueError, match="Key columns missing from columns: ticker"):
+        db.bulk_update(columns_conn, "anomaly", ("trade_time", "distance"), [])
+
+
+def test_something_besides_the_key_is_updated(columns_conn):
+    with pytest.raises(ValueError, match="No columns to update"):
+        db.bulk_update(columns_conn, "anomaly", ("trade_time", "ticker"), [])
+
+
+def test_rows_must_match_columns(columns_conn):
+    with pytest.raises(ValueError, match="Expected 3 values per row, got 2"):
+        db.bulk_update(columns_conn, "anomaly", ("trade_time", "ticker", "distance"), [("t", "X")])
+
+
+def test_unknown_table_is_rejected():
+    db._table_columns.clear()
+    with pytest.raises(ValueError, match="Table missing not found"):
+        db.table_columns(ColumnsConnection([]), "missing")
+
+
+@pytest.fixture
+def conn():
+    if not TEST_DSN:
+        pytest.skip("TEST_DSN not set")
+    import psycopg2
+
+    conn = psycopg2.connect(TEST_DSN, cursor_factory=db.TimedCursor)
+    cursor = conn.cursor()
+    cursor.execute("DROP SCHEMA IF EXISTS bulk_update_test CASCADE;")
+    cursor.execute("CREATE SCHEMA bulk_update_test;")
+    cursor.execute("SET search_path TO bulk_update_test;")
+    cursor.execute(
+        "CREATE TABLE anomaly (trade_time TIMESTAMPTZ NOT NULL, ticker TEXT NOT NULL, "
+        "bot TEXT, distance FLOAT, descr TEXT, PRIMARY KEY (trade_time, ticker));"
+    )
+    cursor.execute(
+        "INSERT INTO anomaly (trade_time, ticker) VALUES "
+        "('2024-01-02T10:00:00Z', 'TSLA'), ('2024-01-02T11:00:00Z', 'TSLA'), "
+        "('2024-01-02T10:00:00Z', 'AAPL');"
+    )
+    # A permanent table with the staging table's name must survive
+    cursor.execute("CREATE TABLE _bulk_anomaly (keep INT);")
+    conn.commit()
+    db._table_columns.clear()
+    yield conn
+    conn.rollback()
+    cursor = conn.cursor()
+    cursor.execute("DROP SCHEMA bulk_update_test CASCADE;")
+    conn.commit()
+    conn.close()
+    db._table_columns.clear()
+
+
+def fetch(conn, query):
+    cursor = conn.cursor()
+    cursor.execute(query)
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+
+def test_update_writes_escaped_values_and_counts_matches(conn):
+    rows = [
+        ("2024-01-02T10:00:00Z", "TSLA", "bot\twith\ttabs", 1.5, "line one\nline two \\ done"),
+        ("2024-01-02T11:00:00Z", "TSLA", None, None, "\\N is not null"),
+        ("2024-01-03T10:00:00Z", "TSLA", "nobody", 9.0, "no such anomaly"),
+    ]
+    updated = db.bulk_update(conn, "anomaly", ("trade_time", "ticker", "bot", "distance", "descr"), rows)
+    conn.commit()
+
+    assert updated == 2
+    assert fetch(conn, "SELECT bot, distance, descr FROM anomaly WHERE ticker = 'TSLA' ORDER BY trade_time;") == [
+        ("bot\twith\ttabs", 1.5, "line one\nline two \\ done"),
+        (None, None, "\\N is not null"),
+    ]
+    assert fetch(conn, "SELECT bot FROM anomaly WHERE ticker = 'AAPL';") == [(None,)]
+    assert fetch(conn, "SELECT count(*) FROM _bulk_anomaly;") == [(0,)]
+
+
+def test_upsert_inserts_missing_rows(conn):
+    rows = [
+        ("2024-01-02T10:00:00Z", "TSLA", 2.0),
+        ("2024-01-03T10:00:00Z", "TSLA", 3.0),
+    ]
+    affected = db.bulk_update(conn, "anomaly", ("trade_time", "ticker", "distance"), rows, upsert=True)
+    conn.commit()
+
+    assert affected == 2
+    assert fetch(conn, "SELECT count(*) FROM anomaly;") == [(4,)]
+    assert fetch(conn, "SELECT distance FROM anomaly WHERE ticker = 'TSLA' ORDER BY trade_time;") == [
+        (2.0,), (None,), (3.0,),
+    ]
+
+
+def test_no_rows_is_a_no_op(conn):
+    assert db.bulk_update(conn, "anomaly", ("trade_time", "ticker", "distance"), []) == 0
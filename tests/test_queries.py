@@ -0,0 +1,78 @@
+# /api/v1/bot-overview payloads (queries.py) built from BOT_OVERVIEW_QUERY
+# rows, and how they render in each ?format=.
+import json
+import os
+import sys
+from datetime import date, datetime, timezone
+
+import pytest
+
+pytest.importorskip("pandas")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import queries  # noqa: E402
+import responses  # noqa: E402
+
+COLUMNS = [
+    "level", "ticker", "bucket", "anomalies", "market", "industry", "company", "other",
+    "unclassified", "distance_mean", "distance_p50", "distance_p90", "distance_p99",
+]
+DESCRIPTION = [(name,) for name in COLUMNS]
+DAY_1 = datetime(2024, 3, 4, tzinfo=timezone.utc)
+DAY_2 = datetime(2024, 3, 5, tzinfo=timezone.utc)
+ROWS = [
+    ("day", None, DAY_1, 2, 1, 0, 1, 0, 0, 1.5, 1.4, 2.0, 2.1),
+    ("day", None, DAY_2, 1, 0, 0, 0, 0, 1, None, None, None, None),
+    ("ticker", "TSLA", None, 3, 1, 0, 1, 0, 1, 1.5, 1.4, 2.0, 2.1),
+    ("total", None, None, 3, 1, 0, 1, 0, 1, 1.5, 1.4, 2.0, 2.1),
+]
+
+
+def test_scorecard_is_the_default_payload():
+    payload, columns = queries.bot_overview(DESCRIPTION, ROWS, "TSLA-bot", None, None)
+
+    assert columns is None
+    assert payload["bot"] == "TSLA-bot" and payload["time_range"] == "1y"
+    assert payload["anomalies"] == 3
+    assert payload["categories"] == {"Market": 1, "Industry": 0, "Company": 1, "Other": 0, "Unclassified": 1}
+    assert [t["ticker"] for t in payload["tickers"]] == ["TSLA"]
+    assert [d["date"] for d in payload["daily"]] == ["2024-03-04", "2024-03-05"]
+
+
+def test_empty_scorecard_has_zero_counts():
+    payload, _ = queries.bot_overview(DESCRIPTION, [], "TSLA-bot", "1m", "records")
+
+    assert payload["anomalies"] == 0 and payload["distance"]["mean"] is None
+    assert payload["tickers"] == [] and payload["daily"] == []
+
+
+@pytest.mark.parametrize("fmt", ["columns", "arrow"])
+def test_tabular_formats_get_the_daily_series(fmt):
+    payload, columns = queries.bot_overview(DESCRIPTION, ROWS, "TSLA-bot", None, fmt)
+
+    assert columns == queries.DAILY_COLUMNS
+    assert payload == [
+        (date(2024, 3, 4), 2, 1, 0, 1, 0, 0, 1.5, 1.4, 2.0, 2.1),
+        (date(2024, 3, 5), 1, 0, 0, 0, 0, 1, None, None, None, None),
+    ]
+
+
+def test_daily_series_renders_as_columns():
+    payload, columns = queries.bot_overview(DESCRIPTION, ROWS, "TSLA-bot", None, "columns")
+    body, _ = responses.render(payload, "columns", columns=columns)
+
+    data = json.loads(body)["data"]
+    assert data["date"] == ["2024-03-04", "2024-03-05"]
+    assert data["anomalies"] == [2, 1]
+    assert data["distance_p99"] == [2.1, None]
+
+
+def test_daily_series_renders_as_arrow():
+    pa = pytest.importorskip("pyarrow")
+    payload, columns = queries.bot_overview(DESCRIPTION, ROWS, "TSLA-bot", None, "arrow")
+    body, _ = responses.render(payload, "arrow", columns=columns)
+
+    table = pa.ipc.open_stream(body).read_all()
+    assert table.column_names == queries.DAILY_COLUMNS
+    assert table.column("date").to_pylist() == [date(2024, 3, 4), date(2024, 3, 5)]
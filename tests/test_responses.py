@@ -0,0 +1,159 @@
+# Response encoding (responses.py): the three formats, datetime output,
+# Accept-Encoding negotiation, compression and the 400 for a bad ?format=.
+import gzip
+import json
+import os
+import sys
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip("pandas")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd  # noqa: E402
+
+import responses  # noqa: E402
+
+COLUMNS = ["trade_time", "ticker", "close"]
+ROWS = [
+    (datetime(2024, 1, 2, 10, tzinfo=timezone.utc), "TSLA", 248.5),
+    (datetime(2024, 1, 2, 11, tzinfo=timezone.utc), "TSLA", None),
+]
+RECORDS = [
+    {"trade_time": "2024-01-02T10:00:00+00:00", "ticker": "TSLA", "close": 248.5},
+    {"trade_time": "2024-01-02T11:00:00+00:00", "ticker": "TSLA", "close": None},
+]
+
+
+def frame():
+    return pd.DataFrame.from_records(ROWS, columns=COLUMNS)
+
+
+def test_records_from_cursor_rows_are_keyed_by_column():
+    body, headers = responses.render(ROWS, columns=COLUMNS)
+    assert json.loads(body) == RECORDS
+    assert headers["Content-Type"] == responses.JSON_MIMETYPE
+
+
+def test_records_from_a_frame_match_cursor_rows():
+    body, _ = responses.render(frame())
+    assert json.loads(body) == RECORDS
+
+
+def test_naive_datetimes_are_written_as_utc():
+    naive = datetime(2024, 1, 2, 10)
+    body, _ = responses.render({"t": naive, "ts": pd.Timestamp(naive)})
+    assert json.loads(body) == {"t": "2024-01-02T10:00:00+00:00", "ts": "2024-01-02T10:00:00+00:00"}
+
+
+def test_columns_from_cursor_rows_and_frames_agree():
+    expected = {
+        "columns": COLUMNS,
+        "data": {
+            "trade_time": ["2024-01-02T10:00:00+00:00", "2024-01-02T11:00:00+00:00"],
+            "ticker": ["TSLA", "TSLA"],
+            "close": [248.5, None],
+        },
+    }
+    body, _ = responses.render(ROWS, "columns", columns=COLUMNS)
+    assert json.loads(body) == expected
+    body, _ = responses.render(frame(), "columns")
+    assert json.loads(body) == expected
+
+
+def test_columns_of_no_rows_keep_their_names():
+    body, _ = responses.render([], "columns", columns=COLUMNS)
+    assert json.loads(body) == {"columns": COLUMNS, "data": {name: [] for name in COLUMNS}}
+
+
+def test_arrow_round_trips():
+    pa = pytest.importorskip("pyarrow")
+    body, headers = responses.render(ROWS, "arrow", columns=COLUMNS)
+    assert headers["Content-Type"] == responses.ARROW_MIMETYPE
+    table = pa.ipc.open_stream(body).read_all()
+    assert table.column_names == COLUMNS
+    assert table.column("close").to_pylist() == [248.5, None]
+
+
+@pytest.mark.parametrize("fmt", ["columns", "arrow"])
+def test_tabular_formats_need_a_table(fmt):
+    with pytest.raises(responses.UnsupportedFormat):
+        responses.render({"total": 1}, fmt)
+
+
+def test_unknown_format_is_unsupported():
+    with pytest.raises(responses.UnsupportedFormat, match="Unsupported format: csv"):
+        responses.render(ROWS, "csv", columns=COLUMNS)
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        (None, None),
+        ("", None),
+        ("identity", None),
+        ("gzip", "gzip"),
+        ("gzip, deflate, br", "br"),
+        ("br;q=0, gzip", "gzip"),
+        ("br;q=0.0, gzip;q=0", None),
+        ("GZIP;q=0.5", "gzip"),
+        ("br;q=oops, gzip", "gzip"),
+        ("*", "br"),
+    ],
+)
+def test_negotiate_encoding(accept_encoding, expected, monkeypatch):
+    monkeypatch.setattr(responses, "brotli", object())
+    assert responses.negotiate_encoding(accept_encoding) == expected
+
+
+def test_negotiate_encoding_without_brotli(monkeypatch):
+    monkeypatch.setattr(responses, "brotli", None)
+    assert responses.negotiate_encoding("br, gzip") == "gzip"
+    assert responses.negotiate_encoding("br") is None
+
+
+def test_small_bodies_are_not_compressed():
+    body, headers = responses.render({"ok": True}, accept_encoding="gzip")
+    assert json.loads(body) == {"ok": True}
+    assert "Content-Encoding" not in headers
+    assert headers["Vary"] == "Accept-Encoding"
+
+
+def test_large_bodies_are_compressed(monkeypatch):
+    monkeypatch.setattr(responses, "brotli", None)
+    rows = ROWS * (responses.COMPRESS_MIN_BYTES // 50)
+    body, headers = responses.render(rows, accept_encoding="gzip", columns=COLUMNS)
+    assert headers["Content-Encoding"] == "gzip"
+    assert len(json.loads(gzip.decompress(body))) == len(rows)
+
+
+# Just the parts of a Flask/Quart request that respond() reads
+class FakeRequest:
+    def __init__(self, args=None, headers=None):
+        self.args = args or {}
+        self.headers = headers or {}
+
+
+def test_respond_encodes_for_the_request():
+    body, status, headers = responses.respond(ROWS, FakeRequest({"format": "columns"}), columns=COLUMNS)
+    assert status == 200
+    assert json.loads(body)["columns"] == COLUMNS
+
+
+def test_respond_rejects_an_unsupported_format():
+    body, status, headers = responses.respond({"total": 1}, FakeRequest({"format": "arrow"}))
+    assert status == 400
+    assert headers == {"Content-Type": responses.JSON_MIMETYPE}
+    assert json.loads(body) == {"error": "Unsupported format: arrow", "provided": "arrow"}
+
+
+def test_datetimes_without_orjson(monkeypatch):
+    monkeypatch.setattr(responses, "orjson", None)
+    df = frame()
+    df["trade_time"] = df["trade_time"].astype("datetime64[ns, UTC]")
+    body, _ = responses.render(df, "columns")
+    assert json.loads(body)["data"]["trade_time"] == ["2024-01-02T10:00:00+00:00", "2024-01-02T11:00:00+00:00"]
+    body, _ = responses.render(df)
+    assert json.loads(body) == RECORDS
@@ -0,0 +1,150 @@
+# SimilarityIndex (similarity.py) on synthetic hourly bars, without a
+# database: incremental indexing, candidate lookup and search results.
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("sklearn")
+pytest.importorskip("fastdtw")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import similarity  # noqa: E402
+from similarity import STRIDE, WINDOW, SimilarityIndex  # noqa: E402
+
+START = datetime(2024, 3, 4, tzinfo=timezone.utc)
+HOURS = 240
+
+
+# `hours` hourly bars from `offset` hours after START, cut from a random walk
+# seeded per ticker
+def bars(seed, hours, offset=0):
+    rng = np.random.default_rng(seed)
+    close = 100 + np.cumsum(rng.normal(0, 1, HOURS))
+    volume = rng.integers(1_000, 5_000, HOURS)
+    return [
+        (START + timedelta(hours=h), close[h] - 0.5, close[h] + 1, close[h] - 1, close[h],
+         int(volume[h]), int(volume[h]) // 10, close[h])
+        for h in range(offset, offset + hours)
+    ]
+
+
+def windows_of(index, ticker):
+    return [index.entries[i] for i in index.by_ticker.get(ticker, [])]
+
+
+def test_bars_up_to_the_watermark_are_skipped():
+    index = SimilarityIndex()
+    rows = bars(1, 60)
+    assert index.add_rows("TSLA", rows[:40]) == (40 - WINDOW) // STRIDE + 1
+    before = list(index.entries)
+
+    assert index.add_rows("TSLA", rows[:40]) == 0
+    assert index.add_rows("TSLA", rows[30:40]) == 0
+    assert index.entries == before
+    assert index.watermarks["TSLA"] == rows[39][0]
+
+    # Overlapping deliveries only contribute the bars after the watermark
+    index.add_rows("TSLA", rows[35:60])
+    starts = [start for _, start, _ in windows_of(index, "TSLA")]
+    assert starts == [rows[i][0] for i in range(0, 60 - WINDOW + 1, STRIDE)]
+
+
+def test_tail_carries_over_between_calls():
+    rows = bars(2, 100)
+    whole = SimilarityIndex()
+    whole.add_rows("TSLA", rows)
+
+    pieces = SimilarityIndex()
+    for start in range(0, len(rows), 7):
+        pieces.add_rows("TSLA", rows[start:start + 7])
+
+    assert pieces.entries == whole.entries
+    for a, b in zip(pieces.windows, whole.windows):
+        np.testing.assert_allclose(a, b)
+    times, matrix = pieces.tails["TSLA"]
+    assert times[0] == whole.entries[-1][1] + timedelta(hours=STRIDE)
+    assert len(times) == len(matrix) == 100 - (len(whole) * STRIDE)
+
+
+def test_query_rows_are_grouped_by_ticker():
+    index = SimilarityIndex()
+    rows = [("AAPL", *row) for row in bars(3, 30)] + [("TSLA", *row) for row in bars(4, 30)]
+    added = index.add_query_rows(rows)
+
+    assert added == 2 * ((30 - WINDOW) // STRIDE + 1)
+    assert set(index.by_ticker) == {"AAPL", "TSLA"}
+    assert not index.needs_refresh()
+    assert index.refresh_params() == (["AAPL", "TSLA"], [rows[29][1], rows[-1][1]])
+
+
+@pytest.fixture
+def index():
+    index = SimilarityIndex()
+    for seed in range(8):
+        index.add_rows(f"T{seed}", bars(seed, 120))
+    return index
+
+
+def test_one_result_per_ticker(index):
+    # Plenty of windows per ticker are close to the query, only the best counts
+    results = index.search(bars(0, WINDOW, offset=48), k=5)
+
+    tickers = [r["ticker"] for r in results]
+    assert len(tickers) == len(set(tickers)) == 5
+    assert results[0]["ticker"] == "T0" and results[0]["distance"] == pytest.approx(0, abs=1e-3)
+    distances = [r["distance"] for r in results]
+    assert distances == sorted(distances)
+
+
+def test_excluded_ticker_is_never_returned(index):
+    results = index.search(bars(0, WINDOW, offset=48), k=10, exclude="T0")
+
+    assert "T0" not in {r["ticker"] for r in results}
+    assert len(results) == 7
+
+
+def test_same_period_only_returns_overlapping_windows(index):
+    query = bars(0, WINDOW, offset=48)
+    begin, end = query[0][0], query[-1][0]
+    results = index.search(query, k=10, exclude="T0", same_period=True)
+
+    assert len(results) == 7
+    for r in results:
+        assert r["end"] >= begin and r["start"] <= end
+
+    # A ticker with no bars in that period has nothing to offer
+    index.add_rows("LATE", bars(9, 40, offset=200))
+    assert "LATE" not in {r["ticker"] for r in index.search(query, k=10, same_period=True)}
+    assert "LATE" in {r["ticker"] for r in index.search(query, k=10)}
+
+
+def test_candidates_merge_tree_and_linear_scan(monkeypatch):
+    monkeypatch.setattr(similarity, "REBUILD_MIN", 40)
+    index = SimilarityIndex()
+    for seed in range(7):
+        index.add_rows(f"T{seed}", bars(seed, 60))
+    assert 0 < index.tree_size < len(index), "some windows must be left to the linear scan"
+
+    embedding = np.array(index.embeddings[-1])
+    expected = np.linalg.norm(np.array(index.embeddings) - embedding, axis=1)
+    for count in (1, 5, len(index)):
+        found = index._candidates(embedding, count)
+        assert [i for _, i in found] == list(np.argsort(expected, kind="stable")[:count])
+        np.testing.assert_allclose([d for d, _ in found], np.sort(expected)[:count])
+
+
+def test_dtw_runs_without_the_lock(index, monkeypatch):
+    dtw_distance = similarity.dtw_distance
+    locked = []
+
+    def recording_dtw(a, b):
+        locked.append(index.lock.locked())
+        return dtw_distance(a, b)
+
+    monkeypatch.setattr(similarity, "dtw_distance", recording_dtw)
+    index.search(bars(0, WINDOW, offset=48), k=3)
+    assert locked and not any(locked)
@@ -0,0 +1,148 @@
+# Replays a recorded websocket session through the streaming ingestion
+# (stream.py) without a database: the micro-batcher's writes are captured.
+#
+# The recording (fixtures/stream_session.jsonl) holds 15-minute bars of TSLA
+# and AAPL over 40 hours. It starts mid-hour, resends one frame as after a
+# reconnect, has one out-of-order bar and a volume/price spike in hour 30.
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("requests")
+pytest.importorskip("sklearn")
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import stream  # noqa: E402
+
+SESSION = os.path.join(HERE, "fixtures", "stream_session.jsonl")
+
+
+class RecordingBatcher(stream.MicroBatcher):
+    def __init__(self, fail_writes=0, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_writes = fail_writes
+        self.written_bars = []
+        self.written_anomalies = []
+
+    def write(self, bars, anomalies):
+        if self.fail_writes:
+            self.fail_writes -= 1
+            raise ConnectionError("connection lost")
+        self.written_bars.extend(bars)
+        self.written_anomalies.extend(anomalies)
+
+
+def minute_bars(ticker):
+    bars = []
+    with open(SESSION) as f:
+        for line in f:
+            bars.extend(m for m in json.loads(line) if m.get("T") == "b" and m["S"] == ticker)
+    return bars
+
+
+def scorers():
+    return {"TSLA": stream.OnlineScorer("TSLA", buffer_size=100, min_fit=12, refit_every=4)}
+
+
+def replay(batcher):
+    clock = stream.ReplayClock()
+    asyncio.run(stream.run(stream.replay_frames(SESSION, clock=clock), scorers(), batcher, clock))
+
+
+def test_replay_writes_each_complete_hour_once():
+    batcher = RecordingBatcher(batch_size=10, flush_seconds=3600)
+    replay(batcher)
+
+    times = [row[0] for row in batcher.written_bars]
+    start = stream.parse_time(minute_bars("TSLA")[0]["t"]).replace(minute=0)
+    # Hour 0 was already under way when the recording started and hour 39
+    # had not ended by the time of its last bar; duplicates and AAPL are
+    # never written
+    assert times == [start + timedelta(hours=h) for h in range(1, 39)]
+    assert {row[-1] for row in batcher.written_bars} == {"TSLA"}
+
+
+def test_hourly_bars_roll_up_minute_bars():
+    batcher = RecordingBatcher(batch_size=10, flush_seconds=3600)
+    replay(batcher)
+
+    hour = datetime.fromisoformat("2024-03-04T05:00:00+00:00")
+    minutes = [b for b in minute_bars("TSLA") if stream.parse_time(b["t"]).replace(minute=0) == hour]
+    trade_time, close, high, low, trades, open_, volume, vwap, ticker = next(
+        row for row in batcher.written_bars if row[0] == hour
+    )
+    assert open_ == minutes[0]["o"]
+    assert close == minutes[-1]["c"]
+    assert high == max(b["h"] for b in minutes)
+    assert low == min(b["l"] for b in minutes)
+    assert volume == sum(b["v"] for b in minutes)
+    assert trades == sum(b["n"] for b in minutes)
+    assert vwap == pytest.approx(sum(b["vw"] * b["v"] for b in minutes) / volume)
+
+
+def test_spike_is_reported_as_anomaly():
+    batcher = RecordingBatcher(batch_size=10, flush_seconds=3600)
+    replay(batcher)
+
+    spike = datetime.fromisoformat("2024-03-04T06:00:00+00:00") + timedelta(days=1)
+    anomalies = [t for t, ticker in batcher.written_anomalies]
+    written = {row[0] for row in batcher.written_bars}
+    assert set(anomalies) <= written
+    # Either flagged itself or folded into an anomaly shortly before it
+    assert any(timedelta(0) <= spike - t <= timedelta(hours=stream.CLUSTER_HOURS) for t in anomalies)
+
+
+def test_failed_flush_keeps_rows_for_the_next_one():
+    batcher = RecordingBatcher(fail_writes=2, batch_size=10, flush_seconds=3600)
+    replay(batcher)
+
+    assert len(batcher.written_bars) == 38
+    assert batcher.bars == [] and batcher.anomalies == []
+
+
+def test_last_hour_closes_on_the_clock_without_a_later_bar():
+    batcher = RecordingBatcher(batch_size=10, flush_seconds=0.01)
+    clock = stream.ReplayClock()
+    last_hour = stream.parse_time(minute_bars("TSLA")[-1]["t"]).replace(minute=0)
+    written_while_connected = []
+
+    # The session stays connected after the recording, but no bar follows
+    async def frames():
+        async for frame in stream.replay_frames(SESSION, clock=clock):
+            yield frame
+        clock.advance(last_hour + timedelta(hours=1, seconds=stream.CLOSE_GRACE_SECONDS - 1))
+        await asyncio.sleep(0.1)
+        early = len(batcher.written_bars) + len(batcher.bars)
+        clock.advance(last_hour + timedelta(hours=1, seconds=stream.CLOSE_GRACE_SECONDS))
+        await asyncio.sleep(0.1)
+        written_while_connected.extend([early, [row[0] for row in batcher.written_bars]])
+
+    asyncio.run(stream.run(frames(), scorers(), batcher, clock))
+
+    early, times = written_while_connected
+    start = stream.parse_time(minute_bars("TSLA")[0]["t"]).replace(minute=0)
+    # Not before the grace period is over, then without waiting for the end
+    assert early == 38
+    assert times == [start + timedelta(hours=h) for h in range(1, 40)]
+    assert times[-1] == last_hour
+
+
+def test_minute_bars_after_their_hour_closed_are_dropped():
+    rollup = stream.HourlyRollup()
+    bar = {"o": 1.0, "h": 1.0, "l": 1.0, "c": 1.0, "v": 10, "n": 1, "vw": 1.0}
+    assert rollup.add({**bar, "t": "2024-03-04T10:00:00Z"}, "TSLA")
+    assert rollup.add({**bar, "t": "2024-03-04T10:58:00Z"}, "TSLA")
+
+    closed = rollup.close_ended("2024-03-04T11:01:00Z")
+    assert [(ticker, hourly["v"]) for ticker, hourly in closed] == [("TSLA", 20)]
+    # A late bar of the closed hour must not reopen it, even after a reconnect
+    rollup.reset()
+    assert not rollup.add({**bar, "t": "2024-03-04T10:59:00Z"}, "TSLA")
+    assert rollup.add({**bar, "t": "2024-03-04T11:00:00Z"}, "TSLA")